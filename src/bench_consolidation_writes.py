@@ -0,0 +1,119 @@
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.consolidation import (
+    ConsolidateResult,
+    ConsolidationJob,
+    apply_consolidation_result,
+)
+from src.conversation import ChatMessage, Role
+from src.db import Base, count_queries, get_engine, get_sessionmaker
+
+# Rows written per second by apply_consolidation_result for large results, on a file
+# backed sqlite db so commits pay for their fsync.
+NUM_ENTITIES = [10, 100, 500]
+FACTS_PER_ENTITY = 3
+ALIASES_PER_ENTITY = 3
+WINDOW_SIZE = 40
+EMBEDDING_DIM = 384
+NUM_REPEATS = 3
+
+
+def make_result(num_entities: int, start: int) -> ConsolidateResult:
+    """A result whose facts and summary reference new and previously written entities."""
+    entity_names = [f"Entity {start + i}" for i in range(num_entities)]
+    older_names = [f"Entity {i}" for i in range(start)][-num_entities:]
+    referenced_names = entity_names + older_names
+    return ConsolidateResult.model_validate(
+        {
+            "summary": {
+                "importance": 5,
+                "salience": 5,
+                "body": f"Everything that happened from entity {start} on.",
+                "relevant_entity_names": referenced_names[:20],
+            },
+            "new_entities": [
+                {
+                    "aliases": [name]
+                    + [f"{name} alias {j}" for j in range(1, ALIASES_PER_ENTITY)],
+                    "brief": f"{name}, met during the benchmark.",
+                }
+                for name in entity_names
+            ],
+            "updated_entities": [],
+            "updated_facts": [],
+            "new_facts": [
+                {
+                    "importance": 5,
+                    "salience": 5,
+                    "body": f"{name} knows fact number {j}.",
+                    "relevant_entity_names": [
+                        name,
+                        referenced_names[(i + 1) % len(referenced_names)],
+                    ],
+                }
+                for i, name in enumerate(entity_names)
+                for j in range(FACTS_PER_ENTITY)
+            ],
+        }
+    )
+
+
+def count_rows(result: ConsolidateResult) -> int:
+    entities = len(result.new_entities)
+    aliases = sum(len(entity.aliases) for entity in result.new_entities)
+    # facts and the summary are written to context_items and their own table
+    items = 2 * (len(result.new_facts) + 1)
+    associations = len(result.new_facts) + len(result.summary.relevant_entity_names)
+    associations += sum(len(fact.relevant_entity_names) for fact in result.new_facts)
+    return entities + aliases + items + associations + WINDOW_SIZE
+
+
+def make_job(start_index: int) -> ConsolidationJob:
+    window = tuple(
+        ChatMessage(
+            content=f"Message {i} of the window.",
+            role=Role.USER if i % 2 == 0 else Role.ASSISTANT,
+        )
+        for i in range(WINDOW_SIZE)
+    )
+    return ConsolidationJob(window=window, start_index=start_index)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine(f"sqlite:///{Path(directory) / 'bench.db'}")
+        Base.metadata.create_all(engine)
+        SessionLocal = get_sessionmaker(engine)
+
+        with SessionLocal() as session:
+            num_written_entities = 0
+            for num_entities in NUM_ENTITIES:
+                timings = []
+                for _ in range(NUM_REPEATS):
+                    result = make_result(num_entities, num_written_entities)
+                    vectors = rng.standard_normal(
+                        (len(result.new_facts) + 1, EMBEDDING_DIM), dtype=np.float32
+                    )
+                    job = make_job(num_written_entities)
+                    with count_queries(engine) as statements:
+                        start = time.perf_counter()
+                        apply_consolidation_result(session, job, result, vectors)
+                        timings.append(time.perf_counter() - start)
+                    num_written_entities += num_entities
+
+                num_rows = count_rows(result)
+                seconds = float(np.median(timings))
+                print(
+                    f"{num_entities:>4} entities, {len(result.new_facts):>4} facts: "
+                    f"{num_rows} rows in {len(statements)} statements, "
+                    f"{seconds * 1000:.1f}ms, {num_rows / seconds:.0f} rows/sec"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+
+from src.dev_load_fulminate import load_fulminate
+from src.embeddings import LocalEmbeddings
+
+# Compares fp32 and int8 quantized LocalEmbeddings on cpu:
+# cold start, throughput at several batch sizes, and top-k retrieval agreement.
+BATCH_SIZES = [1, 8, 32, 64]
+TOP_K = 10
+
+
+def measure_cold_start(quantize: bool) -> tuple[LocalEmbeddings, float]:
+    """Seconds from construction to the first embedding, including imports and model load."""
+    start = time.perf_counter()
+    embeddings = LocalEmbeddings(device="cpu", quantize=quantize)
+    embeddings.embed("warm up")
+    return embeddings, time.perf_counter() - start
+
+
+def measure_throughput(
+    embeddings: LocalEmbeddings, texts: list[str]
+) -> dict[int, float]:
+    texts_per_second = {}
+    for batch_size in BATCH_SIZES:
+        start = time.perf_counter()
+        embeddings.embed(texts, batch_size=batch_size)
+        texts_per_second[batch_size] = len(texts) / (time.perf_counter() - start)
+    return texts_per_second
+
+
+def top_k_agreement(reference: np.ndarray, candidate: np.ndarray, k: int) -> float:
+    """Mean overlap of each text's k nearest neighbours, using every text as a query."""
+
+    def neighbours(vectors):
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        similarities = normalized @ normalized.T
+        np.fill_diagonal(similarities, -np.inf)
+        return np.argsort(-similarities, axis=1)[:, :k]
+
+    reference_neighbours = neighbours(reference)
+    candidate_neighbours = neighbours(candidate)
+    overlaps = [
+        len(set(reference_row) & set(candidate_row)) / k
+        for reference_row, candidate_row in zip(
+            reference_neighbours, candidate_neighbours
+        )
+    ]
+    return float(np.mean(overlaps))
+
+
+def main():
+    texts = [message.content for message in load_fulminate()]
+    print(f"{len(texts)} fulminate messages\n")
+
+    # fp32 first, so its cold start also pays for importing torch
+    results = {}
+    for quantize in (False, True):
+        name = "int8" if quantize else "fp32"
+        embeddings, cold_start = measure_cold_start(quantize)
+        throughput = measure_throughput(embeddings, texts)
+        results[name] = embeddings.embed(texts)
+
+        print(f"{name}: cold start {cold_start:.2f}s")
+        for batch_size, texts_per_second in throughput.items():
+            print(f"  batch {batch_size:>3}: {texts_per_second:.1f} texts/sec")
+
+    agreement = top_k_agreement(results["fp32"], results["int8"], TOP_K)
+    print(f"\ntop-{TOP_K} agreement int8 vs fp32: {agreement:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import aiohttp
+import httpx
+
+import src.conversation
+from src.conversation import MODEL, request_completion
+from src.dev_completion_stub import CompletionStub
+from src.http_client import MAX_CONNECTIONS_PER_HOST, close_http_pool
+from src.rate_limiting import PriorityRateLimiter
+
+# Per-request latency of completion against a local OpenAI-compatible stub, opening a
+# client per request as completion used to versus the shared keep-alive pool.
+# The stub serves https with a throwaway self-signed certificate, so new connections pay
+# for a TLS handshake as they would with the real api. Being on localhost, the saving
+# measured here is a lower bound: real requests would also save DNS lookups and the
+# network round trips of the TCP and TLS handshakes.
+NUM_REQUESTS = 200
+NUM_CONCURRENT_REQUESTS = 64
+MESSAGES = [{"role": "user", "content": "Hello?"}]
+
+
+async def aiohttp_session_per_request(stub: CompletionStub):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{stub.base_url}/chat/completions",
+            json={"model": MODEL, "messages": MESSAGES},
+            ssl=stub.client_ssl_context,
+        ) as response:
+            return await response.json()
+
+
+async def httpx_client_per_request(stub: CompletionStub):
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            f"{stub.base_url}/chat/completions",
+            json={"model": MODEL, "messages": MESSAGES},
+        )
+        return response.json()
+
+
+async def shared_pool(stub: CompletionStub):
+    return await request_completion(MODEL, MESSAGES)
+
+
+async def measure_latencies(
+    send: Callable, stub: CompletionStub, num_requests: int
+) -> List[float]:
+    latencies = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        response = await send(stub)
+        latencies.append(time.perf_counter() - start)
+        assert response["choices"], response
+    return latencies
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        await run_benchmark(CompletionStub(certificate_directory=Path(directory)))
+
+
+async def run_benchmark(stub: CompletionStub):
+    await stub.start()
+    original_base_url = src.conversation.OPENROUTER_BASE_URL
+    original_get_rate_limiter = src.conversation.get_rate_limiter
+    # the stub has no quota to protect, only the request layer is measured
+    unlimited = PriorityRateLimiter(requests_per_minute=1e9, tokens_per_minute=1e12)
+    src.conversation.get_rate_limiter = lambda: unlimited
+    src.conversation.OPENROUTER_BASE_URL = stub.base_url
+    try:
+        print(f"{NUM_REQUESTS} sequential requests each")
+        medians = {}
+        for name, send in [
+            ("aiohttp session per request", aiohttp_session_per_request),
+            ("httpx client per request", httpx_client_per_request),
+            ("shared pool", shared_pool),
+        ]:
+            stub.connections.clear()
+            # one untimed request, so imports and the pool's first connection aren't counted
+            await send(stub)
+            latencies = await measure_latencies(send, stub, NUM_REQUESTS)
+            medians[name] = statistics.median(latencies)
+            print(
+                f"  {name:<28} median {1000 * medians[name]:.2f}ms "
+                f"p90 {1000 * percentile(latencies, 0.9):.2f}ms, "
+                f"{len(stub.connections)} connections"
+            )
+        saved = medians["aiohttp session per request"] - medians["shared pool"]
+        print(f"  shared pool saves {1000 * saved:.2f}ms per request")
+
+        stub.connections.clear()
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(shared_pool(stub) for _ in range(NUM_CONCURRENT_REQUESTS))
+        )
+        print(
+            f"{NUM_CONCURRENT_REQUESTS} concurrent requests through the shared pool: "
+            f"{1000 * (time.perf_counter() - start):.1f}ms, "
+            f"{len(stub.connections)} connections (limit {MAX_CONNECTIONS_PER_HOST})"
+        )
+    finally:
+        src.conversation.OPENROUTER_BASE_URL = original_base_url
+        src.conversation.get_rate_limiter = original_get_rate_limiter
+        await close_http_pool()
+        await stub.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
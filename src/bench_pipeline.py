@@ -0,0 +1,375 @@
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, redirect_stdout
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from sqlalchemy import event
+
+import src.chat_loop
+import src.consolidation
+import src.context_evaluation
+import src.conversation
+from src.chat_loop import ChatLoop
+from src.consolidation import consolidator_agent
+from src.context import prefix_overlap
+from src.context_evaluation import context_evaluator_agent
+from src.conversation import ChatMessage
+from src.db import Base, get_engine, get_sessionmaker
+from src.dev_load_fulminate import load_fulminate
+from src.dev_scripted_evaluation import scripted_evaluation_model
+from src.knowledge_snapshot import get_knowledge_snapshot
+from src.ranking import get_ranker
+from src.summary_compaction import summary_compactor_agent
+from src.tokens import count_tokens
+
+# Replays fulminate_0.txt through ChatLoop with scripted stand-ins for every LLM call,
+# so only the memory pipeline's own overhead is measured.
+# The transcript is replayed several times to grow the conversation and knowledge base.
+NUM_REPLAYS = 10
+REPORT_EVERY_NUM_TURNS = 26
+# pause before each user message, letting background work run as it would between turns
+USER_THINK_SECONDS = 0.05
+MAX_NEW_ENTITIES_PER_CONSOLIDATION = 5
+NUM_FACTS_PER_CONSOLIDATION = 8
+
+ENTITY_NAME_PATTERN = re.compile(r"\b[A-Z][a-z]{2,}(?: [A-Z][a-z]{2,})*\b")
+NOT_ENTITY_NAMES = {"The", "You", "Your", "And", "But", "What", "This", "That", "Bot"}
+
+# statements outside the timed stages, eg saving chat messages
+OTHER_STAGE = "other"
+_current_stage: ContextVar[str] = ContextVar("current_stage", default=OTHER_STAGE)
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    queries: int = 0
+
+
+@dataclass
+class PipelineStats:
+    """Wall time and query counts per stage, since the last report.
+
+    Queries are attributed to the innermost running stage, so consolidation's
+    counts exclude its write. Times of nested stages are included in their parent's.
+    """
+
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    context_tokens: List[int] = field(default_factory=list)
+    context_prefix_overlaps: List[float] = field(default_factory=list)
+
+    def stage(self, name: str) -> StageStats:
+        return self.stages.setdefault(name, StageStats())
+
+    def reset(self):
+        self.stages = {}
+        self.context_tokens = []
+        self.context_prefix_overlaps = []
+
+
+def timed(function, stage: str, stats: PipelineStats, on_result=None):
+    if asyncio.iscoroutinefunction(function):
+
+        async def wrapper(*args, **kwargs):
+            token = _current_stage.set(stage)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                stats.stage(stage).seconds += time.perf_counter() - start
+                stats.stage(stage).calls += 1
+                _current_stage.reset(token)
+
+    else:
+
+        def wrapper(*args, **kwargs):
+            token = _current_stage.set(stage)
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                stats.stage(stage).seconds += time.perf_counter() - start
+                stats.stage(stage).calls += 1
+                _current_stage.reset(token)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+    return wrapper
+
+
+@contextmanager
+def patched(owner, name: str, value):
+    original = getattr(owner, name)
+    setattr(owner, name, value)
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+
+@contextmanager
+def instrument_pipeline(engine, stats: PipelineStats):
+    """Time the pipeline's stages and count each one's statements."""
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        stats.stage(_current_stage.get()).queries += 1
+
+    previous_context_texts = []
+
+    def record_context_size(context):
+        context_text = str(context)
+        stats.context_tokens.append(count_tokens(context_text))
+        if previous_context_texts:
+            stats.context_prefix_overlaps.append(
+                prefix_overlap(previous_context_texts.pop(), context_text)
+            )
+        previous_context_texts.append(context_text)
+
+    ranker = get_ranker()
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        with patched(
+            src.chat_loop,
+            "get_assistant_context",
+            timed(
+                src.chat_loop.get_assistant_context,
+                "context",
+                stats,
+                on_result=record_context_size,
+            ),
+        ), patched(
+            src.context_evaluation,
+            "evaluate_batch",
+            timed(src.context_evaluation.evaluate_batch, "evaluation", stats),
+        ), patched(
+            src.consolidation,
+            "run_consolidation_job",
+            timed(src.consolidation.run_consolidation_job, "consolidation", stats),
+        ), patched(
+            src.consolidation,
+            "apply_consolidation_result",
+            timed(
+                src.consolidation.apply_consolidation_result,
+                "consolidation write",
+                stats,
+            ),
+        ), patched(
+            src.consolidation,
+            "compact_message_summaries",
+            timed(
+                src.consolidation.compact_message_summaries,
+                "summary compaction",
+                stats,
+            ),
+        ), patched(
+            ranker,
+            "schedule_retrain",
+            timed(ranker.schedule_retrain, "ranker", stats),
+        ):
+            yield
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+
+
+class ScriptedConsolidator:
+    """Deterministic stand-in for the consolidator.
+
+    Capitalized names become entities, the first sentences of messages become facts.
+    Names it has already made entities for are referenced rather than created again.
+    """
+
+    def __init__(self):
+        self.known_names: Set[str] = set()
+
+    def respond(self, messages: List[ModelMessage], info: AgentInfo) -> ModelResponse:
+        prompt = messages[-1].parts[-1].content
+        recent_text = prompt.split("RECENT MESSAGES:", 1)[-1]
+        recent_text = recent_text.split("<<Chat Paused", 1)[0]
+        window = [part.split(": ", 1)[-1] for part in recent_text.strip().split("\n\n")]
+
+        name_counts = Counter(
+            name
+            for name in ENTITY_NAME_PATTERN.findall(recent_text)
+            if name not in NOT_ENTITY_NAMES
+        )
+        new_names = [
+            name
+            for name, _ in name_counts.most_common()
+            if name not in self.known_names
+        ][:MAX_NEW_ENTITIES_PER_CONSOLIDATION]
+        self.known_names.update(new_names)
+
+        def names_in(text: str) -> List[str]:
+            return sorted(
+                {name for name in ENTITY_NAME_PATTERN.findall(text)} & self.known_names
+            )
+
+        sentences = [first_sentence(text) for text in window if first_sentence(text)]
+        step = max(len(sentences) // NUM_FACTS_PER_CONSOLIDATION, 1)
+        facts = [
+            {
+                "importance": 1 + len(sentence) % 10,
+                "salience": 1 + len(sentence.split()) % 10,
+                "body": sentence,
+                "relevant_entity_names": names_in(sentence),
+            }
+            for sentence in sentences[::step][:NUM_FACTS_PER_CONSOLIDATION]
+        ]
+        summary = " ".join(sentences[:3]) or "Nothing happened."
+        args = {
+            "summary": {
+                "importance": 5,
+                "salience": 5,
+                "body": summary,
+                "relevant_entity_names": names_in(recent_text)[:10],
+            },
+            "new_entities": [
+                {"aliases": [name], "brief": f"{name}, as mentioned in the chat."}
+                for name in new_names
+            ],
+            "updated_entities": [],
+            "new_facts": facts,
+            "updated_facts": [],
+        }
+        return ModelResponse(parts=[ToolCallPart(info.result_tools[0].name, args)])
+
+
+def first_sentence(text: str) -> str:
+    return re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0][:300]
+
+
+def scripted_compaction(messages: List[ModelMessage], info: AgentInfo) -> ModelResponse:
+    """Merges summaries by keeping the first sentence of each."""
+    prompt = messages[-1].parts[-1].content
+    summaries = re.findall(r"^- (.*)$", prompt, re.MULTILINE)
+    body = " ".join(first_sentence(summary) for summary in summaries)
+    args = {"body": body or "Nothing happened.", "importance": 5, "salience": 5}
+    return ModelResponse(parts=[ToolCallPart(info.result_tools[0].name, args)])
+
+
+class ReplayChatLoop(ChatLoop):
+    """Sends the transcript's user messages, while completion answers with its replies."""
+
+    def __init__(self, session, transcript: List[ChatMessage], on_turn=None):
+        super().__init__(session=session)
+        self.transcript = transcript
+        self.on_turn = on_turn
+        self.num_turns = 0
+
+    async def get_environment_input(
+        self, llm_message: Optional[str] = None
+    ) -> Optional[str]:
+        if self.num_turns and self.on_turn:
+            self.on_turn(self.num_turns)
+        if 2 * self.num_turns >= len(self.transcript):
+            return None
+        await asyncio.sleep(USER_THINK_SECONDS)
+        self.num_turns += 1
+        return self.transcript[2 * self.num_turns - 2].content
+
+    async def completion(
+        self, model, messages, timeout=None, num_retries=0, hedge=False
+    ):
+        reply = self.transcript[2 * self.num_turns - 1].content
+        return {"choices": [{"message": {"content": reply}}]}
+
+
+def load_transcript() -> List[ChatMessage]:
+    transcript = []
+    for _ in range(NUM_REPLAYS):
+        transcript.extend(load_fulminate())
+    return transcript
+
+
+def print_report(report, num_turns: int, session, stats: PipelineStats):
+    snapshot = get_knowledge_snapshot(session)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    mean_context_tokens = (
+        sum(stats.context_tokens) / len(stats.context_tokens)
+        if stats.context_tokens
+        else 0
+    )
+    mean_prefix_overlap = (
+        sum(stats.context_prefix_overlaps) / len(stats.context_prefix_overlaps)
+        if stats.context_prefix_overlaps
+        else 0
+    )
+    print(
+        f"turn {num_turns}: {len(snapshot.facts)} facts, "
+        f"{len(snapshot.message_summaries)} summaries, {len(snapshot.entities)} entities, "
+        f"context {mean_context_tokens:.0f} tokens "
+        f"({100 * mean_prefix_overlap:.0f}% prefix shared with the previous), peak memory {peak_memory / 2**20:.1f}MB",
+        file=report,
+    )
+    for name, stage in sorted(stats.stages.items()):
+        if name == OTHER_STAGE:
+            print(f"  {name:<20} {stage.queries:>4} queries", file=report)
+            continue
+        print(
+            f"  {name:<20} {stage.calls:>4} calls "
+            f"{1000 * stage.seconds / max(stage.calls, 1):>8.1f}ms/call "
+            f"{stage.queries / max(stage.calls, 1):>6.1f} queries/call",
+            file=report,
+        )
+    report.flush()
+    stats.reset()
+
+
+async def main():
+    report = sys.stdout
+    transcript = load_transcript()
+    stats = PipelineStats()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine(f"sqlite:///{Path(directory) / 'bench.db'}")
+        Base.metadata.create_all(engine)
+        SessionLocal = get_sessionmaker(engine)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        with SessionLocal() as session:
+            loop = ReplayChatLoop(
+                session,
+                transcript,
+                on_turn=lambda num_turns: num_turns % REPORT_EVERY_NUM_TURNS == 0
+                and print_report(report, num_turns, session, stats),
+            )
+            # the chat's own printing would drown out the report
+            with open(os.devnull, "w") as devnull, redirect_stdout(
+                devnull
+            ), instrument_pipeline(engine, stats), patched(
+                src.conversation, "HUMAN_MOCK", False
+            ), patched(
+                src.conversation, "completion", loop.completion
+            ), consolidator_agent.override(
+                model=FunctionModel(ScriptedConsolidator().respond)
+            ), context_evaluator_agent.override(
+                # usefulness varying deterministically by id
+                model=scripted_evaluation_model(lambda item_id: item_id % 3)
+            ), summary_compactor_agent.override(
+                model=FunctionModel(scripted_compaction)
+            ):
+                await loop.run()
+
+            print("after draining background work", file=report)
+            print_report(report, loop.num_turns, session, stats)
+        tracemalloc.stop()
+        print(f"\ntotal {time.perf_counter() - start:.1f}s for {loop.num_turns} turns")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
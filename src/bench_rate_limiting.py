@@ -0,0 +1,76 @@
+import asyncio
+import statistics
+import time
+from typing import List
+
+from src.rate_limiting import Priority, PriorityRateLimiter
+
+# Interactive latency while a backlog of consolidation and evaluation calls is waiting on
+# the rate limiter, with priorities versus everything waiting in arrival order.
+# Calls are simulated, only the limiter's scheduling is measured.
+REQUESTS_PER_MINUTE = 300
+TOKENS_PER_MINUTE = 600_000
+BURST_SECONDS = 1
+NUM_CONSOLIDATION_CALLS = 20
+NUM_EVALUATION_CALLS = 40
+NUM_INTERACTIVE_CALLS = 10
+INTERACTIVE_INTERVAL_SECONDS = 0.5
+TOKENS_PER_CALL = 2000
+CALL_SECONDS = 0.05
+
+
+async def call(
+    limiter: PriorityRateLimiter, priority: Priority, waits: List[float] = None
+):
+    start = time.perf_counter()
+    async with limiter.limit(priority, TOKENS_PER_CALL):
+        if waits is not None:
+            waits.append(time.perf_counter() - start)
+        await asyncio.sleep(CALL_SECONDS)
+
+
+async def run_scenario(name: str, use_priorities: bool):
+    limiter = PriorityRateLimiter(
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        burst_seconds=BURST_SECONDS,
+    )
+
+    def priority(priority: Priority) -> Priority:
+        return priority if use_priorities else Priority.EVALUATION
+
+    start = time.perf_counter()
+    background = [
+        asyncio.create_task(call(limiter, priority(Priority.CONSOLIDATION)))
+        for _ in range(NUM_CONSOLIDATION_CALLS)
+    ] + [
+        asyncio.create_task(call(limiter, priority(Priority.EVALUATION)))
+        for _ in range(NUM_EVALUATION_CALLS)
+    ]
+    interactive_waits = []
+    max_queue_depth = 0
+    for _ in range(NUM_INTERACTIVE_CALLS):
+        max_queue_depth = max(max_queue_depth, limiter.queue_depth)
+        await call(limiter, priority(Priority.INTERACTIVE), interactive_waits)
+        await asyncio.sleep(INTERACTIVE_INTERVAL_SECONDS)
+    await asyncio.gather(*background)
+
+    print(
+        f"{name}: interactive wait mean {1000 * statistics.mean(interactive_waits):.0f}ms "
+        f"max {1000 * max(interactive_waits):.0f}ms, backlog of {max_queue_depth} "
+        f"drained in {time.perf_counter() - start:.1f}s"
+    )
+    print(limiter)
+
+
+async def main():
+    print(
+        f"{NUM_CONSOLIDATION_CALLS + NUM_EVALUATION_CALLS} background calls queued at "
+        f"{REQUESTS_PER_MINUTE} requests/min, then {NUM_INTERACTIVE_CALLS} interactive calls"
+    )
+    await run_scenario("arrival order", use_priorities=False)
+    await run_scenario("priorities", use_priorities=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
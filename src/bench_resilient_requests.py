@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import List
+
+import src.conversation
+from src.conversation import MODEL, request_completion
+from src.dev_completion_stub import CompletionStub
+from src.http_client import close_http_pool
+from src.rate_limiting import PriorityRateLimiter
+from src.resilient_requests import CircuitOpenError, ResilientRequester
+
+# Tail latency of completion against a local stub where a few requests stall, with and
+# without hedging, then how retries and the circuit breaker behave when it's down.
+NUM_REQUESTS = 200
+STUB_LATENCY_SECONDS = 0.05
+STALL_EVERY = 25
+STALL_SECONDS = 2.0
+# short enough that stalled requests time out and are retried
+FIXED_TIMEOUT_SECONDS = 0.5
+NUM_REQUESTS_WHILE_DOWN = 8
+MESSAGES = [{"role": "user", "content": "Hello?"}]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+async def run_scenario(
+    name: str, requester: ResilientRequester, num_requests: int, **kwargs
+):
+    latencies = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        await request_completion(MODEL, MESSAGES, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    print(
+        f"{name}: p50 {1000 * percentile(latencies, 0.5):.0f}ms "
+        f"p95 {1000 * percentile(latencies, 0.95):.0f}ms "
+        f"p99 {1000 * percentile(latencies, 0.99):.0f}ms "
+        f"max {1000 * max(latencies):.0f}ms"
+    )
+    print(f"  {requester.counters}")
+
+
+async def main():
+    stub = CompletionStub(
+        first_token_delay=STUB_LATENCY_SECONDS,
+        stall_every=STALL_EVERY,
+        stall_seconds=STALL_SECONDS,
+    )
+    await stub.start()
+    original_base_url = src.conversation.OPENROUTER_BASE_URL
+    original_get_rate_limiter = src.conversation.get_rate_limiter
+    # the stub has no quota to protect, only the request layer is measured
+    unlimited = PriorityRateLimiter(requests_per_minute=1e9, tokens_per_minute=1e12)
+    src.conversation.get_rate_limiter = lambda: unlimited
+    original_get_requester = src.conversation.get_requester
+    src.conversation.OPENROUTER_BASE_URL = stub.base_url
+    try:
+        print(
+            f"{NUM_REQUESTS} sequential requests, 1 in {STALL_EVERY} stalling for {STALL_SECONDS:.0f}s"
+        )
+        for name, kwargs in [
+            ("no hedging", {}),
+            ("hedged after p95", {"hedge": True}),
+            (
+                f"{FIXED_TIMEOUT_SECONDS}s timeout and retries",
+                {"timeout": FIXED_TIMEOUT_SECONDS, "num_retries": 2},
+            ),
+        ]:
+            requester = ResilientRequester()
+            src.conversation.get_requester = lambda: requester
+            await run_scenario(name, requester, NUM_REQUESTS, **kwargs)
+
+        await stub.close()
+        requester = ResilientRequester()
+        src.conversation.get_requester = lambda: requester
+        outcomes = []
+        for _ in range(NUM_REQUESTS_WHILE_DOWN):
+            try:
+                await request_completion(MODEL, MESSAGES)
+                outcomes.append("ok")
+            except CircuitOpenError:
+                outcomes.append("rejected")
+            except Exception as e:
+                outcomes.append(type(e).__name__)
+        print(f"with the stub down: {', '.join(outcomes)}")
+        print(f"  {requester.counters}")
+    finally:
+        src.conversation.OPENROUTER_BASE_URL = original_base_url
+        src.conversation.get_requester = original_get_requester
+        src.conversation.get_rate_limiter = original_get_rate_limiter
+        await close_http_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
-from src.consolidation import should_consolidate, consolidate
-from src.context import get_assistant_context
-from src.context_evaluation import evaluate_context
+from src.consolidation import should_consolidate, ConsolidationWorker
+from src.context import AssistantContext, get_assistant_context, prefix_overlap
+from src.context_evaluation import ContextEvaluationQueue
 from src.conversation import Conversation, ChatMessage, MODEL, Role
 from src.db import Message
+from src.http_client import close_http_pool
+from src.ranking import get_ranker
 from sqlalchemy.orm import Session
 from prompt_toolkit import PromptSession
 from typing import List, Optional
@@ -29,19 +31,39 @@ class ChatLoop(ABC):
         self.conversation = Conversation(
             messages=previous_messages, add_message_callback=save_message
         )
+        self.consolidation_worker = ConsolidationWorker(
+            session=session, conversation=self.conversation
+        )
+        self.evaluation_queue = ContextEvaluationQueue(session=session)
+        # the last context shown, carried over into the next, see get_assistant_context
+        self.previous_context: Optional[AssistantContext] = None
+        # share of each context's tokens in the prefix it shares with the one before
+        self.context_prefix_overlaps: List[float] = []
 
     async def run(self):
-        for _ in range(MAX_CONVERSATION_LENGTH):
-            environment_input = await self.get_environment_input(
-                llm_message=self._get_last_message()
-            )
-            await self.process_response(environment_input=environment_input)
-
-            if should_consolidate(self.conversation):
-                await consolidate(session=self.session, conversation=self.conversation)
+        self.consolidation_worker.start()
+        # trains on the records already in the db, later retrains follow evaluations
+        get_ranker().schedule_retrain(self.session)
+        try:
+            for _ in range(MAX_CONVERSATION_LENGTH):
+                environment_input = await self.get_environment_input(
+                    llm_message=self._get_last_message()
+                )
+                # scripted inputs end the chat by running out
+                if environment_input is None:
+                    break
+                await self.process_response(environment_input=environment_input)
+
+                if should_consolidate(self.conversation):
+                    self.consolidation_worker.request()
+        finally:
+            await self.consolidation_worker.close()
+            await self.evaluation_queue.close()
+            # after the background work, which may still be calling the llm
+            await close_http_pool()
 
     @abstractmethod
-    async def get_environment_input(self, llm_message=Optional[str]) -> str:
+    async def get_environment_input(self, llm_message=Optional[str]) -> Optional[str]:
         pass
 
     async def process_response(
@@ -50,22 +72,39 @@ class ChatLoop(ABC):
     ):
         self.conversation.add_message(message=ChatMessage(content=environment_input))
 
-        context = get_assistant_context(self.session)
+        context = get_assistant_context(
+            self.session,
+            recent_messages=self.conversation.messages,
+            previous_context=self.previous_context,
+        )
+        context_text = str(context)
+        if self.previous_context is not None:
+            self.context_prefix_overlaps.append(
+                prefix_overlap(str(self.previous_context), context_text)
+            )
+        self.previous_context = context
 
         self.conversation.add_message(
-            message=ChatMessage(content=str(context), role=Role.SYSTEM, ephemeral=True),
+            message=ChatMessage(content=context_text, role=Role.SYSTEM, ephemeral=True),
             prepend=True,
         )
+        # a turn without a reply has nothing to grade the context against
+        if await self.generate_response():
+            self.evaluation_queue.add(context=context, conversation=self.conversation)
+
+    async def generate_response(self) -> bool:
+        """Add the assistant's reply to the conversation, False if none was produced."""
         await self.conversation.run(MODEL)
+        return self._is_last_message_a_reply()
 
-        # todo this doesn't need to be awaited in real use I think.
-        await evaluate_context(
-            session=self.session,
-            context=context,
-            conversation=self.conversation,
-        )
+    def _is_last_message_a_reply(self) -> bool:
+        # the turn's context is prepended, so a reply is the only thing appended after
+        # the environment's input
+        return self.conversation.messages[-1].role == Role.ASSISTANT
 
     def _get_last_message(self):
+        if not self.conversation.messages:
+            return None
         return self.conversation.messages[-1].content
 
 
@@ -80,6 +119,17 @@ class HumanChatLoop(ChatLoop):
     async def get_environment_input(self, llm_message: Optional[str] = None) -> str:
         return await self.prompt_session.prompt_async()
 
+    async def generate_response(self) -> bool:
+        """Print the response as it's generated, rather than once it's complete."""
+        is_first_token = True
+        async for token in self.conversation.run_streaming(MODEL):
+            if is_first_token:
+                print("Bot: ", end="")
+                is_first_token = False
+            print(token, end="", flush=True)
+        print("\n\n")
+        return self._is_last_message_a_reply()
+
 
 async def conversation_loop(session: Session, previous_messages=None):
     chat_loop = HumanChatLoop(session=session, previous_messages=previous_messages)
@@ -1,23 +1,41 @@
-from typing import List
+import asyncio
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
+import numpy as np
 from pydantic import BaseModel, Field, conint
 from pydantic_ai import Agent
-from pydantic_ai.models.openai import OpenAIModel
-from pydantic_ai.providers.openai import OpenAIProvider
 from sqlalchemy.orm import Session
 
-from src.conversation import Conversation, ChatMessage, Role, MODEL, OPENROUTER_API_KEY
+from src.conversation import (
+    Conversation,
+    ChatMessage,
+    Role,
+    make_llm_model,
+)
 from src.db import (
+    ContextItem,
     Entity,
     EntityAlias,
     Fact,
     MessageSummary,
     Message,
-    get_entity_by_name,
+    reserve_ids,
 )
+from src.embeddings import get_embeddings
+from src.entity_matching import AliasMatcher
+from src.fact_deduplication import find_duplicate_facts, supersede_fact
+from src.knowledge_snapshot import KnowledgeSnapshot, get_knowledge_snapshot
+from src.rate_limiting import Priority
+from src.summary_compaction import compact_message_summaries
+from src.tokens import count_tokens
 
 MAX_CHAT_WORDS_BEFORE_CONSOLIDATION = 2500
 NUM_WORDS_TO_CONSOLIDATE = 1250
+INGEST_MAX_CONCURRENT_CALLS = 8
+CONSOLIDATOR_CONTEXT_TOKEN_BUDGET = 1500
+# facts most similar to the window are picked from this many nearest context items
+CONSOLIDATOR_CONTEXT_SIMILAR_ITEMS = 50
 
 
 class EntityModel(BaseModel):
@@ -88,31 +106,53 @@ class ConsolidateResult(BaseModel):
 
 
 consolidator_agent = Agent(
-    model=OpenAIModel(
-        MODEL.replace("openrouter/", ""),
-        provider=OpenAIProvider(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY,
-        ),
-    ),
+    model=make_llm_model(Priority.CONSOLIDATION),
     result_type=ConsolidateResult,
 )
 
 
 def should_consolidate(conversation: Conversation):
-    non_hidden_messages = [msg for msg in conversation.messages if not msg.hidden]
-    total_words = sum([msg.num_words for msg in non_hidden_messages])
-    return total_words > MAX_CHAT_WORDS_BEFORE_CONSOLIDATION
+    num_chat_words = (
+        conversation.num_visible_words - conversation.num_visible_prepended_words
+    )
+    return num_chat_words > MAX_CHAT_WORDS_BEFORE_CONSOLIDATION
 
 
-async def consolidate(session: Session, conversation: Conversation):
+@dataclass(frozen=True)
+class ConsolidationJob:
+    """A consolidation window frozen when the job starts, see ConsolidationWorker.
+
+    The chat keeps going while the job runs, its messages are only hidden once the
+    results are in the db.
+    """
+
+    window: Tuple[ChatMessage, ...]
+    start_index: int
+
+
+def freeze_consolidation_job(conversation: Conversation) -> ConsolidationJob:
     consolidation_window, start_index = get_consolidation_window_and_index(conversation)
-    consolidator_context = await get_consolidator_context(consolidation_window)
-    for message in consolidation_window:
-        message.hidden = True
-    # todo get consolidator context from context.py
+    return ConsolidationJob(window=tuple(consolidation_window), start_index=start_index)
+
+
+async def consolidate(session: Session, conversation: Conversation):
+    await run_consolidation_job(session, freeze_consolidation_job(conversation))
+
+
+async def run_consolidation_job(session: Session, job: ConsolidationJob):
+    context, result = await generate_consolidation(session, job)
+    vectors = await embed_consolidation_result(result)
+    apply_consolidation_result(session, job, result, vectors, context)
+    await compact_message_summaries(session)
+
+
+async def generate_consolidation(
+    session: Session, job: ConsolidationJob
+) -> Tuple["ConsolidatorContext", ConsolidateResult]:
+    """The consolidator's result for a window and the context it was shown, without writing to the db."""
+    consolidator_context = await get_consolidator_context(session, list(job.window))
     recent_messages = []
-    for message in consolidation_window:
+    for message in job.window:
         if message.role == Role.ASSISTANT:
             role = "me"
         else:
@@ -134,82 +174,341 @@ It's time to update and maintain your memory system based off of recent events.
 For simplicity, speak in first person, where your character is "I". Out of character text can be written OOC: ...
 """
     result = await consolidator_agent.run(prompt)
+    return consolidator_context, result.data
 
-    # update db
 
-    for alias_row in result.data.new_entities:
-        new_entity = Entity(brief=alias_row.brief)
-        for alias in alias_row.aliases:
-            new_entity.aliases.append(EntityAlias(alias=alias))
-        session.add(new_entity)
-    session.commit()
+async def embed_consolidation_result(result: ConsolidateResult) -> np.ndarray:
+    """Embeddings of the new then updated facts' bodies, followed by the summary's."""
+    # embedding is cpu bound, keep it off the event loop so the chat isn't blocked
+    texts_to_embed = [fact.body for fact in result.new_facts]
+    texts_to_embed.extend(fact.body for fact in result.updated_facts)
+    texts_to_embed.append(result.summary.body)
+    return await asyncio.to_thread(get_embeddings().embed, texts_to_embed)
+
+
+def plan_consolidation_jobs(messages: List[ChatMessage]) -> List[ConsolidationJob]:
+    """The windows consolidating a chat log pair by pair would choose, known up front.
+
+    Windows only depend on word counts, so they're found by replaying the log on copies
+    of its messages, hiding each window as if its consolidation had finished.
+    """
+    copies = [
+        ChatMessage(content=message.content, role=message.role) for message in messages
+    ]
+    originals = dict(zip(copies, messages))
+    conversation = Conversation()
+    jobs = []
+    for i in range(0, len(copies), 2):
+        for copy in copies[i : i + 2]:
+            conversation.add_message(message=copy)
+        if should_consolidate(conversation):
+            job = freeze_consolidation_job(conversation)
+            for message in job.window:
+                message.hidden = True
+            jobs.append(
+                ConsolidationJob(
+                    window=tuple(originals[message] for message in job.window),
+                    start_index=job.start_index,
+                )
+            )
+    return jobs
+
+
+async def ingest_transcript(
+    session: Session,
+    messages: List[ChatMessage],
+    max_concurrent_calls: int = INGEST_MAX_CONCURRENT_CALLS,
+) -> List[ConsolidationJob]:
+    """Consolidate a whole existing chat log.
+
+    The consolidator runs on up to max_concurrent_calls windows at once. Results are applied
+    in window order as soon as every earlier window's are in, so entities a window
+    re-creates are merged into the ones earlier windows made. Summaries are compacted
+    once all windows are in.
+    """
+    jobs = plan_consolidation_jobs(messages)
+    semaphore = asyncio.Semaphore(max_concurrent_calls)
+
+    async def generate(
+        job: ConsolidationJob,
+    ) -> Tuple["ConsolidatorContext", ConsolidateResult]:
+        async with semaphore:
+            return await generate_consolidation(session, job)
+
+    tasks = [asyncio.create_task(generate(job)) for job in jobs]
+    try:
+        for job, task in zip(jobs, tasks):
+            context, result = await task
+            vectors = await embed_consolidation_result(result)
+            apply_consolidation_result(session, job, result, vectors, context)
+    finally:
+        for task in tasks:
+            task.cancel()
+    await compact_message_summaries(session)
+    return jobs
+
+
+def apply_consolidation_result(
+    session: Session,
+    job: ConsolidationJob,
+    result: ConsolidateResult,
+    vectors: np.ndarray,
+    context: Optional["ConsolidatorContext"] = None,
+):
+    """Write a consolidation's results in one transaction, then hide its window.
+
+    vectors are embeddings of the new then updated facts' bodies, followed by the
+    summary's. Updates' indices are looked up in the context the consolidator was shown.
+    Every row gets a reserved id before being added, so the single flush at commit
+    inserts each table with one executemany.
+    """
+    snapshot = get_knowledge_snapshot(session)
+    entity_updates, fact_updates = resolve_updates(snapshot, result, context)
+
+    # An entity the consolidator calls new may already exist, eg when windows were
+    # consolidated concurrently. It's merged into the entity one of its aliases names,
+    # gaining whichever of its aliases are unknown.
+    entity_targets: List[Tuple[EntityModel, Optional[Entity], List[str]]] = []
+    for entity_data in result.new_entities:
+        known = snapshot.resolve_entities(entity_data.aliases)
+        existing = next((entity for entity in known.values() if entity), None)
+        unknown_aliases = [alias for alias in entity_data.aliases if not known[alias]]
+        entity_targets.append((entity_data, existing, unknown_aliases))
+    for entity_data, entity in entity_updates:
+        known = snapshot.resolve_entities(entity_data.aliases)
+        unknown_aliases = [alias for alias in entity_data.aliases if not known[alias]]
+        entity_targets.append((entity_data, entity, unknown_aliases))
+
+    window_messages = [Message(body=msg.content, sender=msg.role) for msg in job.window]
+    ids = reserve_ids(
+        session,
+        {
+            Entity: sum(existing is None for _, existing, _ in entity_targets),
+            EntityAlias: sum(len(aliases) for _, _, aliases in entity_targets),
+            ContextItem: len(result.new_facts) + len(fact_updates) + 1,
+            Message: len(window_messages),
+        },
+    )
 
+    # all referenced names resolved at once in memory, against this job's entities then
+    # the snapshot, so resolving doesn't query the db
+    new_entities = []
+    new_entity_matcher = AliasMatcher()
+    new_entities_by_id = {}
+    for entity_data, existing, unknown_aliases in entity_targets:
+        entity = existing
+        if entity is None:
+            entity = Entity(id=next(ids[Entity]), brief=entity_data.brief)
+            new_entities.append(entity)
+        elif isinstance(entity_data, UpdatedEntityModel):
+            entity.brief = entity_data.brief
+        for alias in unknown_aliases:
+            entity.aliases.append(EntityAlias(id=next(ids[EntityAlias]), alias=alias))
+        for alias in entity_data.aliases:
+            new_entity_matcher.add_alias(alias, entity.id)
+        new_entities_by_id[entity.id] = entity
+
+    referenced_names = list(result.summary.relevant_entity_names)
+    for fact_data in [*result.new_facts, *result.updated_facts]:
+        referenced_names.extend(fact_data.relevant_entity_names)
+    entities_by_name = snapshot.resolve_entities(referenced_names)
+    for name, entity_id in new_entity_matcher.resolve_many(referenced_names).items():
+        if entity_id is not None:
+            entities_by_name[name] = new_entities_by_id[entity_id]
+    for name, entity in entities_by_name.items():
+        if entity is None:
+            print("WARN: entity alias not found: ", name)
+
+    def get_entities(entity_names: List[str]) -> List[Entity]:
+        entities = [entities_by_name[name] for name in entity_names]
+        return list({entity.id: entity for entity in entities if entity}.values())
+
+    # facts repeating one already known replace it, repeats within the batch or of a known
+    # fact already replaced are folded into the new fact kept for them
+    duplicates = find_duplicate_facts(snapshot, vectors[: len(result.new_facts)])
     new_facts = []
-    for fact_data in result.data.new_facts:
+    new_facts_by_index = {}
+    for index, (fact_data, vector) in enumerate(zip(result.new_facts, vectors)):
+        entities = get_entities(fact_data.relevant_entity_names)
+        if index in duplicates.within_batch:
+            kept_fact = new_facts_by_index[duplicates.within_batch[index]]
+            kept_fact.entities = list(
+                {
+                    entity.id: entity for entity in [*kept_fact.entities, *entities]
+                }.values()
+            )
+            continue
+
         new_fact = Fact(
+            id=next(ids[ContextItem]),
             body=fact_data.body,
             importance=fact_data.importance,
             salience=fact_data.salience,
-            created_at_message_index=start_index,
+            created_at_message_index=job.start_index,
+            entities=entities,
         )
-        session.add(new_fact)
-
-        relevant_entities = [
-            get_entity_by_name(session, entity_name)
-            for entity_name in fact_data.relevant_entity_names
-        ]
-        relevant_entities = [entity for entity in relevant_entities if entity]
-        new_fact.entities = relevant_entities
+        new_fact.set_embedding(vector)
+        if index in duplicates.existing:
+            duplicate = snapshot.facts[duplicates.existing[index]]
+            supersede_fact(duplicate, new_fact, message_index=job.start_index)
+        new_facts.append(new_fact)
+        new_facts_by_index[index] = new_fact
 
+    # an updated fact is written as a new version superseding the old one
+    update_vectors = vectors[len(result.new_facts) : len(vectors) - 1]
+    for (fact_data, fact), vector in zip(fact_updates, update_vectors):
+        new_fact = Fact(
+            id=next(ids[ContextItem]),
+            body=fact_data.body,
+            importance=fact_data.importance,
+            salience=fact_data.salience,
+            created_at_message_index=job.start_index,
+            entities=get_entities(fact_data.relevant_entity_names),
+        )
+        new_fact.set_embedding(vector)
+        # a new fact may have already superseded it as a duplicate
+        if fact is not None and fact.retired_by is None:
+            supersede_fact(fact, new_fact, message_index=job.start_index)
         new_facts.append(new_fact)
 
-    entities_in_scene = [
-        get_entity_by_name(session, entity_name)
-        for entity_name in result.data.summary.relevant_entity_names
-    ]
+    entities_in_scene = get_entities(result.summary.relevant_entity_names)
 
+    for message in window_messages:
+        message.id = next(ids[Message])
     new_message_summary = MessageSummary(
+        id=next(ids[ContextItem]),
         # TODO created at message index
-        importance=result.data.summary.importance,
-        salience=result.data.summary.salience,
-        body=result.data.summary.body,
+        importance=result.summary.importance,
+        salience=result.summary.salience,
+        body=result.summary.body,
         facts=new_facts,
         entities=entities_in_scene,
-        messages=[
-            Message(body=msg.content, sender=msg.role) for msg in consolidation_window
-        ],
-        created_at_message_index=start_index,
+        messages=window_messages,
+        created_at_message_index=job.start_index,
     )
+    new_message_summary.set_embedding(vectors[-1])
 
-    session.add(new_message_summary)
-
+    session.add_all([*new_entities, *new_facts, new_message_summary])
     session.commit()
-    return
 
+    for message in job.window:
+        message.hidden = True
+    return
 
-def get_consolidation_window_and_index(conversation: Conversation):
-    start_index = next(
-        (i for i, msg in enumerate(conversation.messages) if not msg.hidden), None
-    )
 
-    # find back half of unhidden messages
-    non_hidden_messages = [msg for msg in conversation.messages if not msg.hidden]
+def resolve_updates(
+    snapshot: KnowledgeSnapshot,
+    result: ConsolidateResult,
+    context: Optional["ConsolidatorContext"],
+) -> Tuple[
+    List[Tuple[UpdatedEntityModel, Entity]],
+    List[Tuple[UpdatedFactModel, Optional[Fact]]],
+]:
+    """The entities and facts the result's updates replace, by their index in the context.
+
+    Updates to entities that are out of range or gone are dropped. Updated facts whose
+    original is out of range or already retired are kept, as new facts.
+    """
+    entity_ids = context.entity_ids if context else []
+    fact_ids = context.fact_ids if context else []
+
+    entity_updates = []
+    for entity_data in result.updated_entities:
+        entity = None
+        if 0 <= entity_data.index < len(entity_ids):
+            entity = snapshot.entities.get(entity_ids[entity_data.index])
+        if entity is None:
+            print("WARN: updated entity not in context: ", entity_data.index)
+            continue
+        entity_updates.append((entity_data, entity))
+
+    fact_updates = []
+    for fact_data in result.updated_facts:
+        fact = None
+        if 0 <= fact_data.index < len(fact_ids):
+            fact = snapshot.facts.get(fact_ids[fact_data.index])
+        if fact is None:
+            print("WARN: updated fact not in context: ", fact_data.index)
+        fact_updates.append((fact_data, fact))
+    return entity_updates, fact_updates
+
+
+class ConsolidationWorker:
+    """Runs consolidation in the background so chat turns never wait on it.
+
+    At most one job runs at a time. Requests made while one is queued coalesce into it,
+    and the window is only chosen when a job starts, so it never overlaps a previous job's.
+    """
+
+    def __init__(self, session: Session, conversation: Conversation):
+        self.session = session
+        self.conversation = conversation
+        self._requests: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._work())
+
+    def request(self):
+        if not self._requests.full():
+            self._requests.put_nowait(True)
+
+    async def _work(self):
+        while True:
+            is_request = await self._requests.get()
+            if not is_request:
+                return
+            # an earlier job may already have covered this request
+            if not should_consolidate(self.conversation):
+                continue
+            job = freeze_consolidation_job(self.conversation)
+            try:
+                await run_consolidation_job(self.session, job)
+            except Exception as e:
+                self.session.rollback()
+                print("CONSOLIDATION FAILED", e)
+
+    async def close(self):
+        """Wait for queued and running jobs to finish, then stop."""
+        if self._task is None:
+            return
+        await self._requests.put(None)
+        await self._task
+        self._task = None
 
-    split_index = 0
-    total_words_in_window = 0
-    while total_words_in_window < NUM_WORDS_TO_CONSOLIDATE:
-        split_index += 2
-        total_words_in_window += non_hidden_messages[split_index - 1].num_words
-        total_words_in_window += non_hidden_messages[split_index].num_words
 
-    consolidate_window = non_hidden_messages[:split_index]
-    return consolidate_window, start_index
+def get_consolidation_window_and_index(conversation: Conversation):
+    """The oldest visible messages holding NUM_WORDS_TO_CONSOLIDATE words, in whole exchanges.
+
+    The turn's ephemeral context is prepended until the response is in, and a job starting
+    mid-turn skips it, so it's never summarized or archived.
+    """
+    num_skipped = conversation.num_visible_prepended_messages
+    num_messages = max(
+        conversation.count_oldest_visible_messages_for_words(
+            conversation.num_visible_prepended_words + NUM_WORDS_TO_CONSOLIDATE
+        )
+        - num_skipped,
+        0,
+    )
+    num_messages = min(
+        num_messages + num_messages % 2,
+        conversation.num_visible_messages - num_skipped,
+    )
+    consolidate_window = conversation.get_visible_messages(
+        start=num_skipped, stop=num_skipped + num_messages
+    )
+    return consolidate_window, conversation.first_visible_appended_index
 
 
 class ConsolidatorContext(BaseModel):
     past_message_summaries: List[MessageSummaryModel]
     entities: List[EntityModel]
     facts: List[FactModel]
+    # db ids of the entities and facts, by the index they're shown with
+    entity_ids: List[int] = []
+    fact_ids: List[int] = []
 
     def __str__(self):
         parts = []
@@ -236,13 +535,77 @@ class ConsolidatorContext(BaseModel):
         return "\n\n".join(parts)
 
 
+def entity_to_model(entity: Entity) -> EntityModel:
+    return EntityModel(
+        aliases=[alias.alias for alias in entity.aliases], brief=entity.brief
+    )
+
+
+def fact_to_model(fact: Fact) -> FactModel:
+    return FactModel(
+        importance=fact.importance,
+        salience=fact.salience,
+        body=fact.body,
+        relevant_entity_names=[str(entity) for entity in fact.entities],
+    )
+
+
 async def get_consolidator_context(
+    session: Session,
     consolidation_window: List[ChatMessage],
+    token_budget: int = CONSOLIDATOR_CONTEXT_TOKEN_BUDGET,
 ) -> ConsolidatorContext:
+    """The entities mentioned in the window, their facts, then the facts most similar to it.
+
+    Filled in that order until token_budget runs out, so the prompt stays the same size
+    however large the knowledge base grows. Everything comes from the snapshot.
+    """
+    snapshot = get_knowledge_snapshot(session)
+    window_text = "\n\n".join(message.content for message in consolidation_window)
+    mentioned_entities = snapshot.find_mentioned_entities(window_text)
+
+    similarity_by_id = {}
+    if window_text and len(snapshot.embedding_index):
+        query_vector = (await asyncio.to_thread(get_embeddings().embed, window_text))[0]
+        item_ids, similarities = snapshot.embedding_index.top_k(
+            query_vector, CONSOLIDATOR_CONTEXT_SIMILAR_ITEMS
+        )
+        similarity_by_id = dict(zip(item_ids, similarities.tolist()))
+
+    linked_fact_ids = {
+        item_id
+        for entity in mentioned_entities
+        for item_id in snapshot.get_item_ids_for_entity(entity.id)
+        if item_id in snapshot.facts
+    }
+    linked_facts = sorted(
+        (snapshot.facts[fact_id] for fact_id in linked_fact_ids),
+        key=lambda fact: (-similarity_by_id.get(fact.id, 0.0), fact.id),
+    )
+    similar_facts = [
+        snapshot.facts[item_id]
+        for item_id in similarity_by_id
+        if item_id in snapshot.facts and item_id not in linked_fact_ids
+    ]
+
+    entities, facts = [], []
+    remaining_tokens = token_budget
+    for item in [*mentioned_entities, *linked_facts, *similar_facts]:
+        if isinstance(item, Entity):
+            model, shown = entity_to_model(item), entities
+        else:
+            model, shown = fact_to_model(item), facts
+        # +2 for the separating blank line, +2 for the index
+        cost = count_tokens(str(model)) + 4
+        if cost > remaining_tokens:
+            break
+        shown.append((item.id, model))
+        remaining_tokens -= cost
 
-    context_summaries = []  # todo use db
-    entities = []
-    facts = []
     return ConsolidatorContext(
-        past_message_summaries=context_summaries, entities=entities, facts=facts
+        past_message_summaries=[],
+        entities=[model for _, model in entities],
+        facts=[model for _, model in facts],
+        entity_ids=[entity_id for entity_id, _ in entities],
+        fact_ids=[fact_id for fact_id, _ in facts],
     )
@@ -1,59 +1,294 @@
+import os
+from typing import Callable, Dict, List, Optional, TypeVar, Union
+
+import numpy as np
 from sqlalchemy.orm import Session
 
-from db import (
+from src.conversation import ChatMessage, get_last_visible_messages
+from src.db import (
+    ContextItem,
     MessageSummary,
     Entity,
     Fact,
+    search_context_items,
 )
+from src.embeddings import LocalEmbeddings, get_embeddings
+from src.knowledge_snapshot import embed_context_items, get_knowledge_snapshot
+from src.ranking import UsefulnessRanker, extract_features, get_ranker
+from src.tokens import count_tokens
+
+NUM_RECENT_MESSAGES_FOR_RETRIEVAL = 4
+TOP_K_CONTEXT_ITEMS = 20
+# embedding search narrows to this many times top_k, then the ranker picks the top_k
+CANDIDATE_POOL_MULTIPLIER = 3
+# added to the ranker's score for items about an entity named in the recent messages
+MENTIONED_ENTITY_BOOST = 0.1
+# added to the score of items in the previous turn's context, so the context drifts rather
+# than reshuffles and the provider's prompt cache can reuse its prefix
+CARRY_OVER_BOOST = 0.1
+CONTEXT_TOKEN_BUDGET = 2000
+
+MESSAGE_SUMMARIES_HEADER = "## Conversation Summary:"
+FACTS_HEADER = "\nFacts:"
+ENTITIES_HEADER = "\n## Key Entities:"
+
+T = TypeVar("T", Entity, Fact)
+
+
+def render_entity(entity: Entity) -> str:
+    return f"{entity.aliases[0].alias}: {entity.brief}"
+
+
+def render_context_item(item: ContextItem) -> str:
+    return item.body
 
 
 class AssistantContext:
-    def __init__(self, session: Session):
-        self.message_summaries = session.query(MessageSummary).all()
+    def __init__(
+        self,
+        message_summaries: List[MessageSummary],
+        entities: List[Entity],
+        facts: List[Fact],
+        dropped_items: Optional[List[Union[ContextItem, Entity]]] = None,
+        similarity_by_id: Optional[Dict[int, float]] = None,
+    ):
+        self.message_summaries = message_summaries
+
+        self.entities = entities
+
+        self.facts = facts
 
-        self.entities = session.query(Entity).all()
+        # candidates that didn't fit in the token budget, and were never shown
+        self.dropped_items = dropped_items or []
 
-        self.facts = session.query(Fact).all()
+        # stored on usage records when evaluated, so the ranker can train on it
+        self.similarity_by_id = similarity_by_id or {}
 
         return
 
-    # TODO want to rank these.
-    # sklearn random forest or mlp to turn the following metrics into the final score
-    # estimating a usefulness score from 0-1 based on UsageRecord.usefulness (normalized)
-
-    # metrics
-    # age, age since updated
-    # importance
-    # salience
-    # LATER keyword matching to recent context, especially last couple messages. Need to implement first.
-    # LATER embedding relevance to the same. Need to implement first.
-    # past usages
-    # usefulness scores across past usages. Just the average or maybe something more clever.
+    # Ranking by age, importance, salience, embedding relevance and past usefulness is in ranking.py
+    # TODO more ranking metrics
+    # Keyword matching to the last couple messages adds FTS candidates, see db.search_context_items
     # context relevant to other relevant context for explainability
     # Later look at relationships between items
-    # ?prefer items that were in previous contexts? May be redundant given the above
+    # Items from the previous context get CARRY_OVER_BOOST and keep their place, see lay_out_stably
 
     def __str__(self):
         context_parts = []
 
-        if self.entities:
-            context_parts.append("## Key Entities:")
-            for entity in self.entities:
-                context_parts.append(f"{entity.aliases[0].alias}: {entity.brief}")
+        # Most stable first, so consecutive turns share a long prefix the provider can cache:
+        # summaries oldest to newest change only on consolidation, facts are carried over
+        # between turns, and entity briefs follow whichever entities were just mentioned
+        if self.message_summaries:
+            context_parts.append(MESSAGE_SUMMARIES_HEADER)
+            for summary in self.message_summaries:
+                context_parts.append(render_context_item(summary))
 
         if self.facts:
-            context_parts.append("\nFacts:")
+            context_parts.append(FACTS_HEADER)
             for fact in self.facts:
-                context_parts.append(fact.body)
+                context_parts.append(render_context_item(fact))
 
-        if self.message_summaries:
-            context_parts.append("\n## Conversation Summary:")
-            for summary in self.message_summaries:
-                context_parts.append(summary.body)
+        if self.entities:
+            context_parts.append(ENTITIES_HEADER)
+            for entity in self.entities:
+                context_parts.append(render_entity(entity))
 
         return "\n".join(context_parts)
 
 
-def get_assistant_context(session: Session) -> AssistantContext:
-    context = AssistantContext(session=session)
+def pack_context(
+    entities: List[Entity],
+    message_summaries: List[MessageSummary],
+    facts: List[Fact],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+    similarity_by_id: Optional[Dict[int, float]] = None,
+) -> AssistantContext:
+    """Fill the token budget in priority order, stopping at the first item that doesn't fit.
+
+    Key info would come first, but isn't implemented yet.
+    Facts should already be sorted most relevant first.
+    """
+    sections: List[tuple[str, list, Callable[..., str]]] = [
+        (ENTITIES_HEADER, entities, render_entity),
+        (MESSAGE_SUMMARIES_HEADER, message_summaries, render_context_item),
+        (FACTS_HEADER, facts, render_context_item),
+    ]
+
+    remaining_tokens = token_budget
+    is_full = False
+    packed_sections = []
+    dropped_items = []
+    for header, items, render in sections:
+        packed = []
+        for item in items:
+            # +1 for the joining newline
+            cost = count_tokens(render(item)) + 1
+            if not packed:
+                cost += count_tokens(header) + 1
+            if is_full or cost > remaining_tokens:
+                is_full = True
+                dropped_items.append(item)
+                continue
+            packed.append(item)
+            remaining_tokens -= cost
+        packed_sections.append(packed)
+
+    packed_entities, packed_summaries, packed_facts = packed_sections
+    return AssistantContext(
+        message_summaries=packed_summaries,
+        entities=packed_entities,
+        facts=packed_facts,
+        dropped_items=dropped_items,
+        similarity_by_id=similarity_by_id,
+    )
+
+
+def lay_out_stably(items: List[T], previous_items: List[T]) -> List[T]:
+    """Items shown last turn first, in the order they were shown, then new items as given.
+
+    Consecutive contexts then share everything up to the first change, rather than
+    reshuffling whenever the ranking does.
+    """
+    items_by_id = {item.id: item for item in items}
+    carried_over = [
+        items_by_id.pop(item.id) for item in previous_items if item.id in items_by_id
+    ]
+    return carried_over + list(items_by_id.values())
+
+
+def prefix_overlap(previous: str, current: str) -> float:
+    """Fraction of current's tokens in the prefix it shares with previous.
+
+    Roughly how much of the prompt a provider's prefix cache could reuse between turns.
+    """
+    if not current:
+        return 1.0
+    return count_tokens(os.path.commonprefix([previous, current])) / count_tokens(
+        current
+    )
+
+
+def get_retrieval_query(recent_messages: List[ChatMessage]) -> str:
+    visible_messages = get_last_visible_messages(
+        recent_messages, NUM_RECENT_MESSAGES_FOR_RETRIEVAL
+    )
+    return "\n\n".join(msg.content for msg in visible_messages)
+
+
+def get_assistant_context(
+    session: Session,
+    recent_messages: Optional[List[ChatMessage]] = None,
+    top_k: int = TOP_K_CONTEXT_ITEMS,
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+    embeddings: Optional[LocalEmbeddings] = None,
+    ranker: Optional[UsefulnessRanker] = None,
+    previous_context: Optional[AssistantContext] = None,
+) -> AssistantContext:
+    """Context for the next response, carrying over what still ranks from previous_context.
+
+    Sections are in a fixed order, and within each, items already shown keep their place
+    and new ones are appended, so the rendered context changes as little as the ranking allows.
+    """
+    recent_messages = recent_messages or []
+    snapshot = get_knowledge_snapshot(session)
+    embedding_index = snapshot.embedding_index
+    pool_size = top_k * CANDIDATE_POOL_MULTIPLIER
+
+    query = get_retrieval_query(recent_messages)
+    query_vector = None
+    candidate_ids, similarities = [], []
+    if query and len(embedding_index):
+        embeddings = embeddings or get_embeddings()
+        query_vector = embeddings.embed(query)[0]
+        candidate_ids, similarities = embedding_index.top_k(query_vector, pool_size)
+
+    # lexical matches, and items about entities mentioned by name, join the pool
+    mentioned_entities = snapshot.find_mentioned_entities(query) if query else []
+    mentioned_item_ids = set()
+    for entity in mentioned_entities:
+        mentioned_item_ids.update(snapshot.get_item_ids_for_entity(entity.id))
+    extra_ids = [
+        item_id
+        for item_id, _ in search_context_items(session, recent_messages, pool_size)
+    ]
+    extra_ids.extend(sorted(mentioned_item_ids))
+    # previous items compete for their place again, retired ones drop out in get_item
+    carried_over_ids = set()
+    if previous_context is not None:
+        carried_over_ids = {
+            item.id
+            for item in previous_context.message_summaries + previous_context.facts
+        }
+        extra_ids.extend(sorted(carried_over_ids))
+    pooled_ids = set(candidate_ids)
+    extra_ids = [i for i in dict.fromkeys(extra_ids) if i not in pooled_ids]
+    if extra_ids:
+        candidate_ids = list(candidate_ids) + extra_ids
+        extra_similarities = (
+            embedding_index.similarities_for(query_vector, extra_ids)
+            if query_vector is not None
+            else np.zeros(len(extra_ids))
+        )
+        similarities = np.concatenate([similarities, extra_similarities])
+
+    if not candidate_ids:
+        # nothing to compare against yet, fall back to the newest items
+        candidate_ids = sorted(embedding_index.item_ids.tolist())[-pool_size:]
+        similarities = np.zeros(len(candidate_ids))
+
+    candidates = []
+    similarity_by_id = {}
+    for item_id, similarity in zip(candidate_ids, similarities):
+        item = snapshot.get_item(item_id)
+        if item is not None:
+            candidates.append(item)
+            similarity_by_id[item_id] = float(similarity)
+
+    ranker = ranker or get_ranker()
+    features = extract_features(
+        candidates,
+        similarities=[similarity_by_id[item.id] for item in candidates],
+        current_message_index=len(recent_messages),
+    )
+    scores = ranker.score(features)
+    is_mentioned = np.array([item.id in mentioned_item_ids for item in candidates])
+    is_carried_over = np.array([item.id in carried_over_ids for item in candidates])
+    scores = (
+        scores
+        + MENTIONED_ENTITY_BOOST * is_mentioned
+        + CARRY_OVER_BOOST * is_carried_over
+    )
+    ranked_items = [candidates[i] for i in np.argsort(-scores, kind="stable")[:top_k]]
+
+    facts = [item for item in ranked_items if isinstance(item, Fact)]
+    message_summaries = sorted(
+        [item for item in ranked_items if isinstance(item, MessageSummary)],
+        key=lambda summary: summary.created_at_message_index,
+    )
+
+    # entity briefs for mentioned entities, then those referenced by the chosen items
+    entities_by_id = {entity.id: entity for entity in mentioned_entities}
+    for item in ranked_items:
+        for entity in item.entities:
+            entities_by_id.setdefault(entity.id, entity)
+    entities = list(entities_by_id.values())
+    if previous_context is not None:
+        # shown briefs first, so the token budget doesn't trade them for new ones
+        entities = lay_out_stably(entities, previous_context.entities)
+
+    # packed in rank order, so the budget keeps the most relevant facts
+    context = pack_context(
+        entities=entities,
+        message_summaries=message_summaries,
+        facts=facts,
+        token_budget=token_budget,
+        similarity_by_id=similarity_by_id,
+    )
+    # new facts oldest first rather than by rank, which shifts between turns.
+    # Summaries are already oldest first, new ones land at the end of their section
+    context.facts = lay_out_stably(
+        sorted(context.facts, key=lambda fact: fact.id),
+        previous_context.facts if previous_context else [],
+    )
     return context
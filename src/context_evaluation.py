@@ -1,63 +1,83 @@
-from typing import List
+import asyncio
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
 
 from pydantic import BaseModel, Field, conint
 from pydantic_ai import Agent
-from pydantic_ai.models.openai import OpenAIModel
-from pydantic_ai.providers.openai import OpenAIProvider
 from sqlalchemy.orm import Session
 
 from src.context import AssistantContext
-from src.conversation import MODEL, OPENROUTER_API_KEY, Conversation, Role
-from src.db import UsageRecord
+from src.conversation import ChatMessage, Conversation, Role, make_llm_model
+from src.ranking import get_ranker
+from src.rate_limiting import Priority
 
 
 class ContextItemEvaluation(BaseModel):
     id: int = Field(description="The ID of the context item being evaluated")
-    usefulness: conint(ge=0, le=2) = Field(
-        description="""\
+    usefulness: conint(ge=0, le=2) = Field(description="""\
 How useful this item was in generating the new message:
 0 = Not useful or relevant to the response. Just noise.
 1 = Somewhat useful or relevant. Maybe wasn't used, but could have been. 
 2 = Clearly useful and influenced the response.
-"""
-    )
+""")
 
 
-class ContextEvaluationResult(BaseModel):
+class TurnEvaluation(BaseModel):
+    turn: int = Field(description="The number of the TURN these evaluations are for")
     evaluations: List[ContextItemEvaluation] = Field(
-        description="Evaluations for each context item that was provided"
+        description="Evaluations for each context item that was provided in this turn"
     )
 
 
+class ContextEvaluationResult(BaseModel):
+    turns: List[TurnEvaluation] = Field(description="Evaluations for every TURN")
+
+
 context_evaluator_agent = Agent(
-    model=OpenAIModel(
-        MODEL.replace("openrouter/", ""),
-        provider=OpenAIProvider(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY,
-        ),
-    ),
+    model=make_llm_model(Priority.EVALUATION),
     result_type=ContextEvaluationResult,
 )
 
+EVALUATION_BATCH_SIZE = 4
+EVALUATION_FLUSH_INTERVAL_SECONDS = 120
 
-async def evaluate_context(
-    session: Session,
-    context: AssistantContext,
-    conversation: Conversation,
-):
-    new_message = conversation.messages[-1]
 
-    # Skip evaluation if there are no context items
-    if not (context.facts or context.entities or context.message_summaries):
-        return
+@dataclass(frozen=True)
+class EvaluationRequest:
+    """A context and the message it was used to write, frozen when the turn ends.
+
+    history is the visible chat before the new message, as it was at the time.
+    """
 
-    context_items_by_id = {}
-    for item in context.facts:
-        context_items_by_id[item.id] = item
-    for item in context.message_summaries:
-        context_items_by_id[item.id] = item
+    context: AssistantContext
+    history: Tuple[ChatMessage, ...]
+    new_message: ChatMessage
+    message_index: int
 
+
+def freeze_evaluation_request(
+    context: AssistantContext, conversation: Conversation
+) -> EvaluationRequest:
+    return EvaluationRequest(
+        context=context,
+        history=tuple(conversation.get_visible_messages(stop=-1)),
+        new_message=conversation.messages[-1],
+        message_index=len(conversation.messages),
+    )
+
+
+def has_items_to_evaluate(context: AssistantContext) -> bool:
+    return bool(context.facts or context.message_summaries)
+
+
+def render_messages(messages: Iterable[ChatMessage]) -> str:
+    return "\n\n".join(
+        f"{'User' if msg.role == Role.USER else 'Me'}: {msg.content}"
+        for msg in messages
+    )
+
+
+def render_evaluation_context(context: AssistantContext) -> str:
     context_parts = []
     if context.entities:
         context_parts.append(
@@ -70,65 +90,168 @@ async def evaluate_context(
                 pass
 
     context_parts.append("\n# Things for you to evaluate:")
-    if context.message_summaries:
-        for summary in context.message_summaries:
-            context_parts.append(f"- [ID:{summary.id}] {summary.body}")
-
-    if context.facts:
-        for fact in context.facts:
-            context_parts.append(f"- [ID:{fact.id}] {fact.body}")
-
-    context_str = "\n".join(context_parts)
-
-    visible_messages = [msg for msg in conversation.messages[:-1] if not msg.hidden]
-    conversation_str = "\n\n".join(
-        [
-            f"{'User' if msg.role == Role.USER else 'Me'}: {msg.content}"
-            for msg in visible_messages
-        ]
-    )
+    for summary in context.message_summaries:
+        context_parts.append(f"- [ID:{summary.id}] {summary.body}")
+    for fact in context.facts:
+        context_parts.append(f"- [ID:{fact.id}] {fact.body}")
 
-    # Format the new message for the evaluator
-    new_message_str = f"Assistant's new response: {new_message.content}"
+    return "\n".join(context_parts)
 
-    # Create the prompt for the evaluator
-    prompt = f"""\
-You are maintaining your memory system, trying to prevent it from building up with irrelevant context and finetune it over time.
-You were having the conversation below (CHAT HISTORY), and you were given the CONTEXT to write your NEW MESSAGE. 
-Now you're evaluating how useful each piece of CONTEXT was for generating that NEW MESSAGE.
 
-CHAT HISTORY
-{conversation_str}
+def build_evaluation_prompt(requests: List[EvaluationRequest]) -> str:
+    """One prompt grading several turns.
 
+    The first turn's history is the shared CHAT HISTORY. Each turn then only shows the
+    messages that appeared since the turn before it, so nothing is repeated.
+    """
+    turn_parts = []
+    seen_messages = set()
+    for turn, request in enumerate(requests):
+        if turn == 0:
+            new_messages = []
+        else:
+            new_messages = [
+                msg for msg in request.history if id(msg) not in seen_messages
+            ]
+        seen_messages.update(id(msg) for msg in request.history)
+        seen_messages.add(id(request.new_message))
+
+        turn_str = f"### TURN {turn}\n"
+        if new_messages:
+            turn_str += (
+                f"MESSAGES SINCE THE PREVIOUS TURN\n{render_messages(new_messages)}\n\n"
+            )
+        turn_str += f"""\
 CONTEXT
-{context_str}
+{render_evaluation_context(request.context)}
+
+NEW MESSAGE (the message you sent in this turn, for which you are evaluating the context's usefulness)
+Assistant's new response: {request.new_message.content}
+"""
+        turn_parts.append(turn_str)
+    turns_str = "\n".join(turn_parts)
+
+    return f"""\
+You are maintaining your memory system, trying to prevent it from building up with irrelevant context and finetune it over time.
+You were having the conversation below (CHAT HISTORY). It continued with the TURNs after it. In each TURN you were given the CONTEXT to write your NEW MESSAGE.
+Now you're evaluating how useful each piece of CONTEXT was for generating the NEW MESSAGE of the same TURN.
 
-NEW MESSAGE (the message you just sent, for which you are evaluating the context's usefulness)
-{new_message_str}
+CHAT HISTORY
+{render_messages(requests[0].history)}
 
-Please evaluate how useful each piece of context was for generating your response.
+{turns_str}
+Please evaluate how useful each piece of context was for generating your response, separately for every TURN.
 """
 
-    # Run the evaluator agent
-    result = await context_evaluator_agent.run(prompt)
 
-    debugging_string_parts = []
-    for evaluation in result.data.evaluations:
-        item = context_items_by_id[evaluation.id]
-        debugging_string_parts.append(f"{evaluation.usefulness}: {item}")
-    debugging_string = "\n".join(debugging_string_parts)
+async def evaluate_batch(session: Session, requests: List[EvaluationRequest]) -> int:
+    """Grade several turns with one evaluator call, and write all their usage records in one commit.
 
-    message_index = len(conversation.messages)
+    Returns the number of usage records written.
+    """
+    requests = [
+        request for request in requests if has_items_to_evaluate(request.context)
+    ]
+    if not requests:
+        return 0
 
-    for evaluation in result.data.evaluations:
-        item_id = evaluation.id
+    result = await context_evaluator_agent.run(build_evaluation_prompt(requests))
 
-        if item_id in context_items_by_id:
-            context_item = context_items_by_id[item_id]
-            usage_record = UsageRecord(
-                context_item_id=context_item.id,
-                created_at_message_index=message_index,
-                usefulness=evaluation.usefulness,
+    usage_records = []
+    for turn_evaluation in result.data.turns:
+        if not 0 <= turn_evaluation.turn < len(requests):
+            continue
+        request = requests[turn_evaluation.turn]
+        context_items_by_id = {
+            item.id: item
+            for item in [*request.context.facts, *request.context.message_summaries]
+        }
+        for evaluation in turn_evaluation.evaluations:
+            context_item = context_items_by_id.get(evaluation.id)
+            if context_item is None:
+                continue
+            usage_records.append(
+                context_item.record_usage(
+                    message_index=request.message_index,
+                    usefulness=evaluation.usefulness,
+                    similarity=request.context.similarity_by_id.get(context_item.id),
+                )
             )
-            session.add(usage_record)
+    # one executemany, the records' ids aren't needed
+    session.bulk_save_objects(usage_records)
     session.commit()
+    return len(usage_records)
+
+
+async def evaluate_context(
+    session: Session,
+    context: AssistantContext,
+    conversation: Conversation,
+):
+    """Grade a single turn right away."""
+    await evaluate_batch(session, [freeze_evaluation_request(context, conversation)])
+
+
+class ContextEvaluationQueue:
+    """Defers context evaluation off the chat turn and grades turns in batches.
+
+    A batch is flushed once batch_size turns are queued, or flush_interval seconds after
+    the oldest queued turn, whichever is first. At most one flush runs at a time.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        batch_size: int = EVALUATION_BATCH_SIZE,
+        flush_interval: float = EVALUATION_FLUSH_INTERVAL_SECONDS,
+    ):
+        self.session = session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: List[EvaluationRequest] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._timer_task: Optional[asyncio.Task] = None
+
+    def add(self, context: AssistantContext, conversation: Conversation):
+        if not has_items_to_evaluate(context):
+            return
+        self._pending.append(freeze_evaluation_request(context, conversation))
+        if len(self._pending) >= self.batch_size:
+            self._start_flush(include_partial=False)
+        elif self._timer_task is None or self._timer_task.done():
+            self._timer_task = asyncio.create_task(self._flush_after_interval())
+
+    async def _flush_after_interval(self):
+        await asyncio.sleep(self.flush_interval)
+        self._start_flush(include_partial=True)
+
+    def _start_flush(self, include_partial: bool):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush(include_partial))
+
+    async def _flush(self, include_partial: bool):
+        while len(self._pending) >= self.batch_size or (
+            include_partial and self._pending
+        ):
+            batch = self._pending[: self.batch_size]
+            self._pending = self._pending[self.batch_size :]
+            try:
+                num_records = await evaluate_batch(self.session, batch)
+            except Exception as e:
+                self.session.rollback()
+                print("CONTEXT EVALUATION FAILED", e)
+                continue
+            # loads the training data here in the background, rather than on a turn
+            get_ranker().schedule_retrain(self.session, num_new_records=num_records)
+        if self._pending and (self._timer_task is None or self._timer_task.done()):
+            self._timer_task = asyncio.create_task(self._flush_after_interval())
+
+    async def close(self):
+        """Evaluate everything still queued, then stop."""
+        if self._timer_task is not None:
+            self._timer_task.cancel()
+            self._timer_task = None
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush(include_partial=True)
+        self._flush_task = None
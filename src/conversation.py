@@ -1,15 +1,30 @@
 import enum
+import json
 import os
+import time
+from dataclasses import dataclass
 from pathlib import Path
 import asyncio
+from bisect import insort
+from typing import AsyncIterator, Dict, List, Optional
 
-import aiohttp
+from pydantic_ai.models import Model
+from pydantic_ai.models.openai import OpenAIModel
+from pydantic_ai.providers.openai import OpenAIProvider
 
-PROJECT_ROOT = Path(__file__).resolve().parents
-for parent in PROJECT_ROOT:
-    if (parent / ".git").exists():
-        PROJECT_ROOT = parent
-        break
+from src.http_client import get_http_client
+from src.llm_cache import CachedModel, get_llm_cache
+from src.paths import PROJECT_ROOT
+from src.prefix_sums import FenwickTree
+from src.rate_limiting import (
+    Permit,
+    Priority,
+    RateLimitedModel,
+    estimate_tokens,
+    get_rate_limiter,
+)
+from src.resilient_requests import RETRYABLE_STATUS_CODES, get_requester
+from src.tokens import count_tokens
 
 HUMAN_MOCK = True
 
@@ -28,32 +43,174 @@ def get_api_key(key_name):
 
 MODEL = "openrouter/anthropic/claude-3.7-sonnet"
 OPENROUTER_API_KEY = get_api_key("OPENROUTER_API_KEY")
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
 
-async def completion(model, messages, timeout=60, num_retries=0):
+def make_llm_model(priority: Priority) -> Model:
+    """MODEL for pydantic_ai agents, through the shared connection pool, rate limiter and llm cache."""
+    return CachedModel(
+        RateLimitedModel(
+            OpenAIModel(
+                MODEL.replace("openrouter/", ""),
+                provider=OpenAIProvider(
+                    base_url=OPENROUTER_BASE_URL,
+                    api_key=OPENROUTER_API_KEY,
+                    http_client=get_http_client(),
+                ),
+            ),
+            priority,
+        )
+    )
+
+
+async def completion(
+    model,
+    messages,
+    timeout=None,
+    num_retries=0,
+    hedge=False,
+    priority=Priority.INTERACTIVE,
+):
+    """Chat completion response json, answered from the llm cache when it has one recorded."""
+    cache = get_llm_cache()
+    key = cache.make_key(model, messages)
+    recorded = cache.get(key)
+    if recorded is not None:
+        return json.loads(recorded)
+
+    response = await request_completion(
+        model, messages, timeout, num_retries, hedge, priority
+    )
+    # errors and failed requests aren't worth replaying
+    if response and "choices" in response:
+        cache.put(key, model, json.dumps(response))
+    return response
+
+
+async def request_completion(
+    model,
+    messages,
+    timeout=None,
+    num_retries=0,
+    hedge=False,
+    priority=Priority.INTERACTIVE,
+):
+    """Chat completion response json, through the shared requester's retries and hedging.
+
+    timeout is per attempt, adapted to recent latencies when None. Raises once retries
+    run out, see ResilientRequester.call. Every attempt, retries and hedges included,
+    takes its own quota from the rate limiter.
+    """
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    }
+    data = {
+        "model": model.replace("openrouter/", ""),
+        "messages": messages,
+    }
+
+    async def send(permit: Permit):
+        response = await get_http_client().post(
+            url=f"{OPENROUTER_BASE_URL}/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=None,
+        )
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            response.raise_for_status()
+        response_json = response.json()
+        permit.record_usage((response_json.get("usage") or {}).get("total_tokens"))
+        return response_json
+
+    return await get_requester().call(
+        send,
+        num_retries=num_retries,
+        hedge=hedge,
+        timeout=timeout,
+        rate_limiter=get_rate_limiter(),
+        priority=priority,
+        estimated_tokens=estimate_tokens(render_prompt(messages)),
+    )
+
+
+def render_prompt(messages) -> str:
+    return "\n\n".join(message["content"] for message in messages)
+
+
+async def stream_completion(
+    model, messages, timeout=60, priority=Priority.INTERACTIVE
+) -> AsyncIterator[str]:
+    """The response's content as it's generated, from the api's server-sent events.
+
+    A response recorded in the llm cache is yielded whole, and a streamed one is recorded
+    as the response completion would have returned.
+    """
+    cache = get_llm_cache()
+    key = cache.make_key(model, messages)
+    recorded = cache.get(key)
+    if recorded is not None:
+        yield json.loads(recorded)["choices"][0]["message"]["content"]
+        return
+
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
     }
     data = {
         "model": model.replace("openrouter/", ""),
         "messages": messages,
+        "stream": True,
     }
+    chunks = []
+    prompt = render_prompt(messages)
+    async with get_rate_limiter().limit(
+        priority, estimate_tokens(prompt)
+    ) as permit, get_http_client().stream(
+        "POST",
+        url=f"{OPENROUTER_BASE_URL}/chat/completions",
+        headers=headers,
+        json=data,
+        timeout=timeout,
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            # other lines are blank separators or comments sent while waiting
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:") :].strip()
+            if payload == "[DONE]":
+                break
+            event = json.loads(payload)
+            if "error" in event:
+                raise RuntimeError(f"Completion stream failed: {event['error']}")
+            choices = event.get("choices") or [{}]
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                chunks.append(content)
+                yield content
+        permit.record_usage(count_tokens(prompt) + count_tokens("".join(chunks)))
+
+    cache.put(
+        key,
+        model,
+        json.dumps({"choices": [{"message": {"content": "".join(chunks)}}]}),
+    )
+
 
-    async with aiohttp.ClientSession() as session:
-        for _ in range(1 + num_retries):
-            try:
-                async with session.post(
-                    url="https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=timeout,
-                ) as response:
-                    return await response.json()
-            except aiohttp.ClientError as e:
-                print(f"Error: {e}")
-                if num_retries > 0:
-                    await asyncio.sleep(1)
-                    continue
+@dataclass
+class ResponseStats:
+    """Timing of one streamed response. Tokens are counted in the final text."""
+
+    time_to_first_token: Optional[float]
+    total_seconds: float
+    num_tokens: int
+
+    @property
+    def tokens_per_second(self) -> float:
+        # generation speed once it started, so the wait for the first token isn't counted
+        generation_seconds = self.total_seconds - (self.time_to_first_token or 0.0)
+        if generation_seconds <= 0:
+            return 0.0
+        return self.num_tokens / generation_seconds
 
 
 class Role(enum.Enum):
@@ -79,10 +236,24 @@ class ChatMessage:
         self.content = content
         self.role = role
         self.ephemeral = ephemeral
-        self.hidden = hidden
+        self._hidden = hidden
+        # conversations indexing this message, told when it's hidden or shown
+        self._conversations: List["Conversation"] = []
 
         self.num_words = len(content.split())
 
+    @property
+    def hidden(self):
+        return self._hidden
+
+    @hidden.setter
+    def hidden(self, hidden):
+        if hidden == self._hidden:
+            return
+        self._hidden = hidden
+        for conversation in self._conversations:
+            conversation._on_visibility_change(self)
+
     def __str__(self):
         return f"{self.role.value}: {self.content}\n"
 
@@ -90,63 +261,262 @@ class ChatMessage:
         return {"role": self.role.value, "content": self.content}
 
 
+def get_last_visible_messages(
+    messages: List[ChatMessage], num_messages: int
+) -> List[ChatMessage]:
+    """The last num_messages visible messages, scanning back from the end only as far as needed."""
+    visible_messages = []
+    for message in reversed(messages):
+        if len(visible_messages) == num_messages:
+            break
+        if not message.hidden:
+            visible_messages.append(message)
+    visible_messages.reverse()
+    return visible_messages
+
+
 class Conversation:
     def __init__(self, messages=None, add_message_callback=None):
         if messages is None:
             messages = []
         self.messages: list[ChatMessage] = messages
         self.add_message_callback = add_message_callback
+        # one per streamed response, see run_streaming
+        self.response_stats: List[ResponseStats] = []
+
+        # Index of the visible messages, kept current by add_message and ChatMessage.hidden,
+        # so messages must only be added through add_message.
+        # Appended messages get running visible counts and word counts in fenwick trees.
+        # Prepended messages are the per-turn ephemeral context, hidden after every run,
+        # so the few still visible are kept in a plain list.
+        self._appended: List[ChatMessage] = []
+        self._appended_positions: Dict[ChatMessage, int] = {}
+        self._visible_counts = FenwickTree()
+        self._visible_words = FenwickTree()
+        self._prepended_positions: Dict[ChatMessage, int] = {}
+        self._visible_prepended: List[ChatMessage] = []
+        self._num_visible_prepended_words = 0
+        self._visible_ephemeral: List[ChatMessage] = []
+        for message in messages:
+            self._index_message(message, prepend=False)
 
     def add_message(self, message: ChatMessage, prepend=False):
         if prepend:
             self.messages.insert(0, message)
         else:
             self.messages.append(message)
+        self._index_message(message, prepend=prepend)
 
         if self.add_message_callback:
             self.add_message_callback(message=message)
         return self
 
-    async def run(self, model, should_print=True, max_messages=None) -> str:
-        message_to_show = [msg for msg in self.messages if not msg.hidden]
-        if max_messages:
-            message_to_show = message_to_show[-max_messages:]
-
-        if HUMAN_MOCK:
-            print("\nMOCK MODE: Please provide a response for the following prompt:\n")
-            print("Context:")
-            for msg in message_to_show:
-                print(msg)
-            response_text = input("Enter your response: ")
+    def _index_message(self, message: ChatMessage, prepend: bool):
+        message._conversations.append(self)
+        if message.ephemeral and not message.hidden:
+            self._visible_ephemeral.append(message)
+
+        if prepend:
+            self._prepended_positions[message] = len(self._prepended_positions)
+            if not message.hidden:
+                self._visible_prepended.insert(0, message)
+                self._num_visible_prepended_words += message.num_words
+            return
+
+        self._appended_positions[message] = len(self._appended)
+        self._appended.append(message)
+        self._visible_counts.append(0 if message.hidden else 1)
+        self._visible_words.append(0 if message.hidden else message.num_words)
+
+    def _on_visibility_change(self, message: ChatMessage):
+        sign = -1 if message.hidden else 1
+        position = self._appended_positions.get(message)
+        if position is not None:
+            self._visible_counts.add(position, sign)
+            self._visible_words.add(position, sign * message.num_words)
+            return
+
+        if message.hidden:
+            self._visible_prepended.remove(message)
         else:
-            llm_friendly_messages = [
-                message.to_llm_friendly() for message in message_to_show
-            ]
-            try:
-                response = await completion(
-                    model=model,
-                    messages=llm_friendly_messages,
-                    timeout=60,
-                    num_retries=2,
+            # newest prepend first
+            insort(
+                self._visible_prepended,
+                message,
+                key=lambda msg: -self._prepended_positions[msg],
+            )
+        self._num_visible_prepended_words += sign * message.num_words
+
+    @property
+    def num_visible_messages(self) -> int:
+        return len(self._visible_prepended) + self._visible_counts.total
+
+    @property
+    def num_visible_words(self) -> int:
+        return self._num_visible_prepended_words + self._visible_words.total
+
+    @property
+    def num_visible_prepended_messages(self) -> int:
+        """The current turn's context, until the run hides it."""
+        return len(self._visible_prepended)
+
+    @property
+    def num_visible_prepended_words(self) -> int:
+        return self._num_visible_prepended_words
+
+    @property
+    def first_visible_index(self) -> Optional[int]:
+        """Index in messages of the oldest visible message."""
+        if self._visible_prepended:
+            return (
+                len(self._prepended_positions)
+                - 1
+                - self._prepended_positions[self._visible_prepended[0]]
+            )
+        return self.first_visible_appended_index
+
+    @property
+    def first_visible_appended_index(self) -> Optional[int]:
+        """Index in messages of the oldest visible message that wasn't prepended."""
+        if not self._visible_counts.total:
+            return None
+        return len(self._prepended_positions) + self._visible_counts.search(1) - 1
+
+    def get_visible_messages(
+        self, start: int = 0, stop: Optional[int] = None
+    ) -> List[ChatMessage]:
+        """Slice of the visible messages, like [msg for msg in messages if not msg.hidden][start:stop]."""
+        start, stop, _ = slice(start, stop).indices(self.num_visible_messages)
+        if stop <= start:
+            return []
+
+        messages = self._visible_prepended[start:stop]
+        num_prepended = len(self._visible_prepended)
+        appended_start = max(start - num_prepended, 0)
+        num_appended = stop - max(start, num_prepended)
+        if num_appended > 0:
+            position = self._visible_counts.search(appended_start + 1) - 1
+            while num_appended:
+                message = self._appended[position]
+                if not message.hidden:
+                    messages.append(message)
+                    num_appended -= 1
+                position += 1
+        return messages
+
+    def count_oldest_visible_messages_for_words(self, num_words: int) -> int:
+        """How many of the oldest visible messages it takes to reach num_words, or all of them."""
+        if num_words <= 0:
+            return 0
+        words = 0
+        for i, message in enumerate(self._visible_prepended):
+            words += message.num_words
+            if words >= num_words:
+                return i + 1
+        length = self._visible_words.search(num_words - words)
+        if length is None:
+            return self.num_visible_messages
+        return len(self._visible_prepended) + self._visible_counts.prefix_sum(length)
+
+    def hide_ephemeral_messages(self):
+        for message in self._visible_ephemeral:
+            message.hidden = True
+        self._visible_ephemeral = []
+
+    async def run(self, model, should_print=True, max_messages=None) -> str:
+        """The response, added as a message, or "(No response)" and the error if it failed.
+
+        The turn's ephemeral context is hidden whichever way it ends.
+        """
+        try:
+            message_to_show = self.get_visible_messages(
+                start=-max_messages if max_messages else 0
+            )
+
+            if HUMAN_MOCK:
+                print(
+                    "\nMOCK MODE: Please provide a response for the following prompt:\n"
                 )
-                response_text = response["choices"][0]["message"]["content"]
-            except Exception as e:
-                print("COMPLETION FAILED. Try to manually fix before continuing.", e)
+                print("Context:")
+                for msg in message_to_show:
+                    print(msg)
+                response_text = input("Enter your response: ")
+            else:
+                llm_friendly_messages = [
+                    message.to_llm_friendly() for message in message_to_show
+                ]
                 try:
+                    # hedged, as a stalled request here is a stalled reply
                     response = await completion(
                         model=model,
                         messages=llm_friendly_messages,
-                        timeout=60,
                         num_retries=2,
+                        hedge=True,
                     )
                     response_text = response["choices"][0]["message"]["content"]
                 except Exception as e:
+                    print("COMPLETION FAILED.", e)
                     return f"(No response) {e}"
-        self.add_message(ChatMessage(content=response_text, role=Role.ASSISTANT))
-        if should_print:
-            print(f"Bot: {response_text}\n\n")
-
-        for message in self.messages:
-            if message.ephemeral:
-                message.hidden = True
-        return response_text
+            self.add_message(ChatMessage(content=response_text, role=Role.ASSISTANT))
+            if should_print:
+                print(f"Bot: {response_text}\n\n")
+
+            return response_text
+        finally:
+            self.hide_ephemeral_messages()
+
+    async def run_streaming(self, model, max_messages=None) -> AsyncIterator[str]:
+        """Like run, but yields the response as it arrives instead of printing it.
+
+        The whole response is added as a message once the stream ends, and its timing
+        appended to response_stats. The turn's ephemeral context is hidden whichever way
+        it ends, even without a response.
+        """
+        try:
+            message_to_show = self.get_visible_messages(
+                start=-max_messages if max_messages else 0
+            )
+
+            start = time.perf_counter()
+            time_to_first_token = None
+            chunks = []
+            if HUMAN_MOCK:
+                print(
+                    "\nMOCK MODE: Please provide a response for the following prompt:\n"
+                )
+                print("Context:")
+                for msg in message_to_show:
+                    print(msg)
+                response_text = input("Enter your response: ")
+                time_to_first_token = time.perf_counter() - start
+                chunks.append(response_text)
+                yield response_text
+            else:
+                llm_friendly_messages = [
+                    message.to_llm_friendly() for message in message_to_show
+                ]
+                try:
+                    async for token in stream_completion(
+                        model=model, messages=llm_friendly_messages, timeout=60
+                    ):
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - start
+                        chunks.append(token)
+                        yield token
+                except Exception as e:
+                    # what was already shown is kept, as the reader has seen it
+                    print("\nCOMPLETION FAILED.", e)
+
+            response_text = "".join(chunks)
+            if not response_text:
+                return
+            self.response_stats.append(
+                ResponseStats(
+                    time_to_first_token=time_to_first_token,
+                    total_seconds=time.perf_counter() - start,
+                    num_tokens=count_tokens(response_text),
+                )
+            )
+            self.add_message(ChatMessage(content=response_text, role=Role.ASSISTANT))
+        finally:
+            self.hide_ephemeral_messages()
@@ -1,5 +1,8 @@
-from typing import List, Optional
+import re
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 from sqlalchemy import (
     create_engine,
     Column,
@@ -10,6 +13,13 @@ from sqlalchemy import (
     Enum,
     CheckConstraint,
     Integer,
+    LargeBinary,
+    event,
+    func,
+    inspect,
+    select,
+    text,
+    update,
 )
 from sqlalchemy.orm import (
     declarative_base,
@@ -20,7 +30,7 @@ from sqlalchemy.orm import (
 )
 import enum
 
-from src.conversation import Role
+from src.conversation import ChatMessage, Role, get_last_visible_messages
 
 Base = declarative_base()
 
@@ -60,6 +70,8 @@ class UsageRecord(Base):
     context_item_id: Mapped[int] = mapped_column(ForeignKey("context_items.id"))
     created_at_message_index: Mapped[int] = mapped_column()
     usefulness: Mapped[int] = mapped_column(Integer)
+    # embedding similarity to the recent messages when the item was provided, a ranker feature
+    similarity: Mapped[Optional[float]] = mapped_column(nullable=True)
 
     context_item: Mapped["ContextItem"] = relationship(
         "ContextItem", back_populates="usage_records"
@@ -76,6 +88,9 @@ class ContextItem(Base):
     __mapper_args__ = {
         "polymorphic_on": "item_type",
         "polymorphic_identity": "context_item",
+        # the aggregates' python defaults are always sent, so there's nothing to fetch
+        # back, and fetching would force an INSERT ... RETURNING per row on sqlite
+        "eager_defaults": False,
     }
     item_type: Mapped[str] = mapped_column(String(50))
 
@@ -96,24 +111,62 @@ class ContextItem(Base):
         ),
     )
 
+    # indexed, as every context query filters out retired items
     retired_by: Mapped[int] = mapped_column(
-        ForeignKey("context_items.id"), nullable=True
+        ForeignKey("context_items.id"), nullable=True, index=True
     )
 
+    # Usage aggregates, kept up to date by record_usage so ranking doesn't load usage_records
+    num_times_provided: Mapped[int] = mapped_column(default=0, server_default="0")
+    num_times_useful: Mapped[int] = mapped_column(default=0, server_default="0")
+    usefulness_sum: Mapped[int] = mapped_column(default=0, server_default="0")
+    last_provided_message_index: Mapped[Optional[int]] = mapped_column(nullable=True)
+
+    # float32 bytes from LocalEmbeddings, written when consolidation creates the item
+    embedding: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+
     def __str__(self):
         return f"Context Item {self.id} (importance: {self.importance}, salience: {self.salience})"
 
     @property
     def times_provided(self):
-        """Backward compatibility property that counts all usage records"""
-        return len(self.usage_records) if self.usage_records else 0
+        """Backward compatibility property, reads the materialized aggregate"""
+        return self.num_times_provided or 0
 
     @property
     def times_useful(self):
-        """Backward compatibility property that counts usage records with usefulness > 0"""
-        if not self.usage_records:
-            return 0
-        return sum(1 for record in self.usage_records if record.usefulness > 0)
+        """Backward compatibility property, reads the materialized aggregate"""
+        return self.num_times_useful or 0
+
+    def record_usage(
+        self, message_index: int, usefulness: int, similarity: Optional[float] = None
+    ) -> "UsageRecord":
+        """Make a UsageRecord for this item, keeping the aggregate columns in step with it.
+
+        The record isn't appended to usage_records, to avoid lazy loading the whole list.
+        """
+        self.num_times_provided = (self.num_times_provided or 0) + 1
+        if usefulness > 0:
+            self.num_times_useful = (self.num_times_useful or 0) + 1
+        self.usefulness_sum = (self.usefulness_sum or 0) + usefulness
+        self.last_provided_message_index = max(
+            self.last_provided_message_index or 0, message_index
+        )
+        return UsageRecord(
+            context_item_id=self.id,
+            created_at_message_index=message_index,
+            usefulness=usefulness,
+            similarity=similarity,
+        )
+
+    @property
+    def embedding_vector(self) -> Optional[np.ndarray]:
+        if self.embedding is None:
+            return None
+        return np.frombuffer(self.embedding, dtype=np.float32)
+
+    def set_embedding(self, vector: np.ndarray):
+        self.embedding = np.asarray(vector, dtype=np.float32).tobytes()
 
 
 class Message(Base):
@@ -140,6 +193,8 @@ class MessageSummary(ContextItem):
 
     id: Mapped[int] = mapped_column(ForeignKey("context_items.id"), primary_key=True)
     body: Mapped[str] = mapped_column(Text)
+    # 0 summarizes messages, level n + 1 merges a run of level n summaries, which it retires
+    level: Mapped[int] = mapped_column(default=0, server_default="0")
 
     facts: Mapped[List["Fact"]] = relationship(
         secondary=message_summary_fact_association, back_populates="message_summaries"
@@ -188,16 +243,53 @@ class EntityAlias(Base):
         return self.alias
 
 
-def get_entity_by_name(session, entity_name: str) -> Optional[Entity]:
-    alias_row = (
-        session.query(EntityAlias)
-        .filter(EntityAlias.alias == entity_name)
-        .one_or_none()
+def usage_aggregates_update():
+    """Recompute every item's usage aggregates from usage_records, eg for a db made before they existed."""
+    records = UsageRecord.__table__
+    items = ContextItem.__table__
+
+    def per_item(column):
+        return (
+            select(column)
+            .where(records.c.context_item_id == items.c.id)
+            .scalar_subquery()
+        )
+
+    return update(items).values(
+        num_times_provided=per_item(func.count(records.c.id)),
+        num_times_useful=per_item(
+            func.count(records.c.id).filter(records.c.usefulness > 0)
+        ),
+        usefulness_sum=per_item(func.coalesce(func.sum(records.c.usefulness), 0)),
+        last_provided_message_index=per_item(
+            func.max(records.c.created_at_message_index)
+        ),
     )
-    if not alias_row:
-        print("WARN: entity alias not found: ", entity_name)
-        return None
-    return alias_row.entity
+
+
+def reserve_ids(session, counts: Dict[type, int]) -> Dict[type, Iterator[int]]:
+    """Primary keys for rows about to be inserted by this transaction, read in one query.
+
+    Objects given their ids up front are inserted with one executemany per table,
+    instead of an INSERT ... RETURNING per row. Subclasses share their base table's ids,
+    so reserve those under the base, eg ContextItem for facts and summaries.
+    Only valid while this session is the db's single writer.
+    """
+    models = list(counts)
+    max_ids = session.execute(
+        select(
+            *[
+                select(
+                    func.coalesce(func.max(model.__table__.c.id), 0)
+                ).scalar_subquery()
+                for model in models
+            ]
+        )
+    ).one()
+    return {
+        model: iter(range(max_id + 1, max_id + 1 + counts[model]))
+        for model, max_id in zip(models, max_ids)
+    }
 
 
 class FactType(enum.Enum):
@@ -274,13 +366,206 @@ class Fact(ContextItem):
     # )
 
 
+@contextmanager
+def count_queries(engine) -> Iterator[List[str]]:
+    """Collect the SQL statements the engine executes inside the block."""
+    statements = []
+
+    def on_before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", on_before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", on_before_cursor_execute)
+
+
+# (table, text column) pairs mirrored into FTS5 tables for lexical search
+SEARCH_INDEXED_COLUMNS = (
+    ("facts", "body"),
+    ("message_summaries", "body"),
+    ("entities", "brief"),
+    ("entity_aliases", "alias"),
+)
+
+NUM_RECENT_MESSAGES_FOR_SEARCH = 4
+MAX_SEARCH_TERMS = 64
+# entity matches are spread to the entity's facts and summaries at a discount
+ENTITY_MATCH_WEIGHT = 0.5
+
+SEARCH_STOP_WORDS = frozenset("""
+    the and for are but not you all any can had her was one our out has him his how
+    its let may she too use who did get got yes what when where which while with would
+    this that there their them they then than these those from have been were will
+    into your just like some about could should also very well okay over only
+    """.split())
+
+
+@event.listens_for(Base.metadata, "after_create")
+def add_missing_columns(target, connection, **kwargs):
+    """Add columns and indexes added to the models since the db was made.
+
+    create_all only creates missing tables, so an existing table is altered in place.
+    New columns must be nullable or have a server_default. Usage aggregates are
+    computed from usage_records when they're first added.
+    """
+    inspector = inspect(connection)
+    added_columns = set()
+    for table in target.sorted_tables:
+        existing_columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            connection.exec_driver_sql(ddl)
+            added_columns.add((table.name, column.name))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+    if (ContextItem.__tablename__, "num_times_provided") in added_columns:
+        connection.execute(usage_aggregates_update())
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_search_index(target, connection, **kwargs):
+    """FTS5 tables kept in sync with their source tables by triggers.
+
+    Tables are created if missing, and filled from existing rows when first created.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+
+    for table, column in SEARCH_INDEXED_COLUMNS:
+        fts_table = f"{table}_fts"
+        already_exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": fts_table},
+        ).first()
+
+        connection.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} "
+            f"USING fts5({column}, content='{table}', content_rowid='id')"
+        )
+        connection.exec_driver_sql(
+            f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+            END"""
+        )
+        connection.exec_driver_sql(
+            f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            END"""
+        )
+        connection.exec_driver_sql(
+            f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {column} ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+            END"""
+        )
+
+        if not already_exists:
+            connection.exec_driver_sql(
+                f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"
+            )
+
+
+def build_search_query(messages: List[ChatMessage]) -> Optional[str]:
+    """FTS5 MATCH expression OR-ing the distinct meaningful words of the last few visible messages."""
+    visible_messages = get_last_visible_messages(
+        messages, NUM_RECENT_MESSAGES_FOR_SEARCH
+    )
+
+    terms = {}
+    for message in reversed(visible_messages):
+        for word in re.findall(r"[^\W_]+", message.content.lower()):
+            if len(word) > 2 and word not in SEARCH_STOP_WORDS:
+                terms.setdefault(word, None)
+    if not terms:
+        return None
+    # most recent words first, so the cap drops older ones
+    return " OR ".join(f'"{term}"' for term in list(terms)[:MAX_SEARCH_TERMS])
+
+
+def search_context_items(
+    session, messages: List[ChatMessage], limit: int = 50
+) -> List[Tuple[int, float]]:
+    """BM25 ranked (context item id, score) pairs for the recent messages, best first.
+
+    Matches on an entity's brief or aliases count towards the entity's facts and summaries.
+    Retired items are excluded.
+    """
+    match_query = build_search_query(messages)
+    if match_query is None:
+        return []
+
+    # bm25() is lower for better matches, so scores are negated
+    rows = session.execute(
+        text("""
+            WITH matches(item_id, rank) AS (
+                SELECT rowid, bm25(facts_fts) FROM facts_fts
+                WHERE facts_fts MATCH :query
+                UNION ALL
+                SELECT rowid, bm25(message_summaries_fts) FROM message_summaries_fts
+                WHERE message_summaries_fts MATCH :query
+            ),
+            entity_matches(entity_id, rank) AS (
+                SELECT rowid, bm25(entities_fts) FROM entities_fts
+                WHERE entities_fts MATCH :query
+                UNION ALL
+                SELECT entity_aliases.entity_id, bm25(entity_aliases_fts)
+                FROM entity_aliases_fts
+                JOIN entity_aliases ON entity_aliases.id = entity_aliases_fts.rowid
+                WHERE entity_aliases_fts MATCH :query
+            ),
+            entity_item_matches(item_id, rank) AS (
+                SELECT entity_fact_association.fact_id, entity_matches.rank * :entity_weight
+                FROM entity_matches
+                JOIN entity_fact_association
+                    ON entity_fact_association.entity_id = entity_matches.entity_id
+                UNION ALL
+                SELECT message_summary_entity_association.message_summary_id,
+                    entity_matches.rank * :entity_weight
+                FROM entity_matches
+                JOIN message_summary_entity_association
+                    ON message_summary_entity_association.entity_id = entity_matches.entity_id
+            ),
+            all_matches(item_id, rank) AS (
+                SELECT item_id, rank FROM matches
+                UNION ALL
+                SELECT item_id, rank FROM entity_item_matches
+            )
+            SELECT all_matches.item_id, -SUM(all_matches.rank) AS score
+            FROM all_matches
+            JOIN context_items ON context_items.id = all_matches.item_id
+            WHERE context_items.retired_by IS NULL
+            GROUP BY all_matches.item_id
+            ORDER BY score DESC
+            LIMIT :limit
+            """),
+        {"query": match_query, "entity_weight": ENTITY_MATCH_WEIGHT, "limit": limit},
+    )
+    return [(item_id, score) for item_id, score in rows]
+
+
 def get_engine(db_url="sqlite:///memory.db"):
     return create_engine(db_url)
 
 
 def get_sessionmaker(engine=None):
     engine = engine or get_engine()
-    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    # Objects stay loaded after commit, so the long-lived KnowledgeSnapshot can
+    # read them without refreshing from the db.
+    return sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+    )
 
 
 # Usage:
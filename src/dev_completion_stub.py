@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import ssl
+import subprocess
+from pathlib import Path
+from typing import Optional, Set, Tuple
+
+from aiohttp import web
+
+# Local OpenAI-compatible chat completions server, for benchmarks and trying the client
+# without calling the real api. Point src.conversation.OPENROUTER_BASE_URL at base_url.
+STUB_HOST = "127.0.0.1"
+STUB_REPLY = "Hello from the stub."
+
+
+def make_response(reply: str) -> dict:
+    return {
+        "id": "stub",
+        "object": "chat.completion",
+        "model": "stub",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 1,
+            "completion_tokens": len(reply.split()),
+            "total_tokens": 1 + len(reply.split()),
+        },
+    }
+
+
+def make_chunk(delta: dict, finish_reason: Optional[str] = None) -> dict:
+    return {
+        "id": "stub",
+        "object": "chat.completion.chunk",
+        "model": "stub",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+class CompletionStub:
+    """Answers every chat completion with the same reply, counting the connections used.
+
+    Requests with "stream": true get the reply word by word as server-sent events, after
+    first_token_delay and then token_delay between words, like a model generating it.
+    Other requests get it whole, once it would have finished streaming.
+    Every stall_every-th request stalls for stall_seconds first, like an overloaded backend.
+    With a certificate_directory it serves https, see make_certificate.
+    """
+
+    def __init__(
+        self,
+        reply: str = STUB_REPLY,
+        certificate_directory: Optional[Path] = None,
+        first_token_delay: float = 0.0,
+        token_delay: float = 0.0,
+        stall_every: int = 0,
+        stall_seconds: float = 0.0,
+    ):
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.stall_every = stall_every
+        self.stall_seconds = stall_seconds
+        self.num_requests = 0
+        self.ssl_context = None
+        self.client_ssl_context = None
+        if certificate_directory is not None:
+            self.ssl_context, cert_path = make_certificate(certificate_directory)
+            # aiohttp's default context is made on import, before SSL_CERT_FILE is set
+            self.client_ssl_context = ssl.create_default_context(cafile=cert_path)
+        self.connections: Set[tuple] = set()
+        self.base_url = ""
+        self._runner = None
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.connections.add(request.transport.get_extra_info("peername"))
+        self.num_requests += 1
+        if self.stall_every and self.num_requests % self.stall_every == 0:
+            await asyncio.sleep(self.stall_seconds)
+        words = self.reply.split(" ")
+        if not body.get("stream"):
+            # as long as streaming every word would take
+            await asyncio.sleep(
+                self.first_token_delay + self.token_delay * (len(words) - 1)
+            )
+            return web.json_response(make_response(self.reply))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        # comment lines keep the connection alive while waiting, as OpenRouter sends
+        await response.write(b": STUB PROCESSING\n\n")
+        await asyncio.sleep(self.first_token_delay)
+        await self.write_event(response, make_chunk({"role": "assistant"}))
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            token = word if i == len(words) - 1 else f"{word} "
+            await self.write_event(response, make_chunk({"content": token}))
+        await self.write_event(response, make_chunk({}, finish_reason="stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    async def write_event(response: web.StreamResponse, data: dict):
+        await response.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.handle_completion)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, STUB_HOST, 0, ssl_context=self.ssl_context)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        scheme = "https" if self.ssl_context else "http"
+        self.base_url = f"{scheme}://{STUB_HOST}:{port}"
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+def make_certificate(directory: Path) -> Tuple[ssl.SSLContext, Path]:
+    """Server context for a self-signed certificate, and the certificate's path.
+
+    httpx clients trust it through SSL_CERT_FILE.
+    """
+    cert_path, key_path = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            f"/CN={STUB_HOST}",
+            "-addext",
+            f"subjectAltName=IP:{STUB_HOST}",
+            "-keyout",
+            str(key_path),
+            "-out",
+            str(cert_path),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.environ["SSL_CERT_FILE"] = str(cert_path)
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert_path, key_path)
+    return server_context, cert_path
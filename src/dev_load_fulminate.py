@@ -1,10 +1,12 @@
 from pathlib import Path
 
-from src.conversation import ChatMessage, Role
+from src.conversation import PROJECT_ROOT, ChatMessage, Role
 
 
 def load_fulminate() -> list[ChatMessage]:
     path = Path("../fulminate_0.txt")
+    if not path.exists():
+        path = PROJECT_ROOT / "fulminate_0.txt"
     text = path.read_text()
     parts = text.split("\n\n\n")
 
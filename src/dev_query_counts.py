@@ -0,0 +1,102 @@
+from typing import Tuple
+
+from src.context import embed_context_items, get_assistant_context
+from src.context_evaluation import context_evaluator_agent, evaluate_context
+from src.conversation import ChatMessage, Conversation, Role
+from src.db import (
+    Base,
+    Entity,
+    EntityAlias,
+    Fact,
+    MessageSummary,
+    count_queries,
+    get_engine,
+    get_sessionmaker,
+)
+from src.dev_scripted_evaluation import scripted_evaluation_model
+
+# Checks that the SQL statements for a chat turn don't grow with the knowledge base.
+NUM_ENTITIES_SMALL = 20
+NUM_ENTITIES_LARGE = 400
+
+
+def populate(session, num_entities: int):
+    items = []
+    for i in range(num_entities):
+        entity = Entity(brief=f"Agent number {i}, met during operation {i % 7}.")
+        entity.aliases.append(EntityAlias(alias=f"Agent {i}"))
+        entity.aliases.append(EntityAlias(alias=f"A{i}"))
+        session.add(entity)
+        for j in range(2):
+            items.append(
+                Fact(
+                    body=f"Agent {i} carries item {j} and distrusts agent {i + j + 1}.",
+                    importance=5,
+                    salience=5,
+                    created_at_message_index=i,
+                    entities=[entity],
+                )
+            )
+        if i % 5 == 0:
+            items.append(
+                MessageSummary(
+                    body=f"I met Agent {i} at the safehouse and we argued.",
+                    importance=4,
+                    salience=4,
+                    created_at_message_index=i,
+                    entities=[entity],
+                )
+            )
+    session.add_all(items)
+    embed_context_items(items)
+    session.commit()
+
+
+async def run_turn(session, conversation: Conversation):
+    conversation.add_message(ChatMessage(content="What does Agent 3 carry?"))
+    context = get_assistant_context(session, recent_messages=conversation.messages)
+    str(context)
+    conversation.add_message(
+        ChatMessage(content="Agent 3 carries item 1.", role=Role.ASSISTANT)
+    )
+    with context_evaluator_agent.override(
+        model=scripted_evaluation_model(lambda item_id: 1)
+    ):
+        await evaluate_context(
+            session=session, context=context, conversation=conversation
+        )
+
+
+async def count_turn_queries(num_entities: int) -> Tuple[int, int]:
+    """Statements for the first turn (loading the knowledge snapshot) and a steady state turn."""
+    engine = get_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    SessionLocal = get_sessionmaker(engine)
+    with SessionLocal() as session:
+        populate(session, num_entities)
+        conversation = Conversation()
+        with count_queries(engine) as first_turn_statements:
+            await run_turn(session, conversation)
+        with count_queries(engine) as steady_turn_statements:
+            await run_turn(session, conversation)
+    return len(first_turn_statements), len(steady_turn_statements)
+
+
+async def main():
+    small = await count_turn_queries(NUM_ENTITIES_SMALL)
+    large = await count_turn_queries(NUM_ENTITIES_LARGE)
+    print(
+        f"{NUM_ENTITIES_SMALL} entities: first turn {small[0]}, steady turn {small[1]}"
+    )
+    print(
+        f"{NUM_ENTITIES_LARGE} entities: first turn {large[0]}, steady turn {large[1]}"
+    )
+    # The first turn's snapshot load may only grow by selectinload's batches of 500 ids
+    if large[1] > small[1]:
+        raise RuntimeError("Queries per turn grow with the number of entities")
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(main())
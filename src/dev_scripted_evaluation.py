@@ -0,0 +1,32 @@
+import re
+from typing import Callable, List
+
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+# Stand-in for the context evaluator in benchmarks and dev scripts, so they run without
+# calling the llm. Use with context_evaluator_agent.override(model=...).
+
+
+def scripted_evaluation_model(usefulness: Callable[[int], int]) -> FunctionModel:
+    """Grades every item of every turn in the evaluation prompt with usefulness(item id)."""
+
+    def evaluate(messages: List[ModelMessage], info: AgentInfo) -> ModelResponse:
+        prompt = messages[-1].parts[-1].content
+        turns = [
+            {
+                "turn": int(turn),
+                "evaluations": [
+                    {"id": int(item_id), "usefulness": usefulness(int(item_id))}
+                    for item_id in re.findall(r"\[ID:(\d+)]", turn_prompt)
+                ],
+            }
+            for turn, turn_prompt in re.findall(
+                r"### TURN (\d+)\n(.*?)(?=### TURN|\Z)", prompt, re.DOTALL
+            )
+        ]
+        return ModelResponse(
+            parts=[ToolCallPart(info.result_tools[0].name, {"turns": turns})]
+        )
+
+    return FunctionModel(evaluate)
@@ -0,0 +1,60 @@
+import time
+
+import src.conversation
+from src.conversation import MODEL, ChatMessage, Conversation
+from src.dev_completion_stub import CompletionStub
+from src.http_client import close_http_pool
+
+# Streams replies from the local completion stub, printing tokens as they arrive, then
+# compares when the first text appears with waiting for the whole response.
+STUB_REPLY = (
+    "The lighthouse keeper had not spoken to anyone in weeks, "
+    "but the gulls had started to recognise the sound of his boots on the stairs."
+)
+FIRST_TOKEN_DELAY_SECONDS = 0.3
+TOKEN_DELAY_SECONDS = 0.03
+NUM_TURNS = 3
+
+
+async def main():
+    stub = CompletionStub(
+        reply=STUB_REPLY,
+        first_token_delay=FIRST_TOKEN_DELAY_SECONDS,
+        token_delay=TOKEN_DELAY_SECONDS,
+    )
+    await stub.start()
+    original_base_url = src.conversation.OPENROUTER_BASE_URL
+    original_human_mock = src.conversation.HUMAN_MOCK
+    src.conversation.OPENROUTER_BASE_URL = stub.base_url
+    src.conversation.HUMAN_MOCK = False
+    try:
+        conversation = Conversation()
+        for turn in range(NUM_TURNS):
+            conversation.add_message(ChatMessage(f"Tell me a story, part {turn + 1}."))
+            print("Bot: ", end="")
+            async for token in conversation.run_streaming(MODEL):
+                print(token, end="", flush=True)
+            stats = conversation.response_stats[-1]
+            print(
+                f"\n  first token after {1000 * stats.time_to_first_token:.0f}ms, "
+                f"whole response {1000 * stats.total_seconds:.0f}ms, "
+                f"{stats.num_tokens} tokens at {stats.tokens_per_second:.1f} tokens/sec\n"
+            )
+
+        conversation.add_message(ChatMessage("And without streaming?"))
+        start = time.perf_counter()
+        await conversation.run(MODEL, should_print=False)
+        print(
+            f"without streaming, nothing shows for {1000 * (time.perf_counter() - start):.0f}ms"
+        )
+    finally:
+        src.conversation.OPENROUTER_BASE_URL = original_base_url
+        src.conversation.HUMAN_MOCK = original_human_mock
+        await close_http_pool()
+        await stub.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(main())
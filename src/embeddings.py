@@ -1,7 +1,122 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import List, Union
-import torch
+from typing import Dict, List, Optional, Tuple, Union
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+
+from src.paths import PROJECT_ROOT
+
+# torch and sentence_transformers are imported when the model is first used,
+# so code paths that never embed don't pay for them.
+
+CacheKey = Tuple[str, bool, str]
+
+EMBEDDING_CACHE_PATH = str(PROJECT_ROOT / "embedding_cache.db")
+
+
+class EmbeddingCache:
+    """Two tier embedding cache: an in-memory LRU in front of an SQLite blob table.
+
+    Entries are keyed by (model_name, normalize flag, sha256 of the text), so cached
+    vectors are never reused across models or normalization settings.
+    """
+
+    def __init__(self, db_path: Optional[str] = EMBEDDING_CACHE_PATH, max_memory_items: int = 10000):
+        """
+        Args:
+            db_path: SQLite file for the on-disk tier, or None for memory only
+            max_memory_items: Number of vectors kept in the LRU tier before evicting
+        """
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[CacheKey, np.ndarray]" = OrderedDict()
+
+        # embed may be called from worker threads, eg by background consolidation
+        self._lock = threading.RLock()
+        self._connection = None
+        if db_path is not None:
+            self._connection = sqlite3.connect(db_path, check_same_thread=False)
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    model_name TEXT NOT NULL,
+                    normalized INTEGER NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model_name, normalized, text_hash)
+                )"""
+            )
+            self._connection.commit()
+
+    @staticmethod
+    def make_key(model_name: str, normalized: bool, text: str) -> CacheKey:
+        return model_name, normalized, hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[CacheKey]) -> Dict[CacheKey, np.ndarray]:
+        """Look up keys in memory first, then fetch the rest from disk in one query per model."""
+        with self._lock:
+            return self._get_many(keys)
+
+    def _get_many(self, keys: List[CacheKey]) -> Dict[CacheKey, np.ndarray]:
+        found = {}
+        disk_misses = []
+        for key in keys:
+            vector = self._memory.get(key)
+            if vector is None:
+                disk_misses.append(key)
+            else:
+                self._memory.move_to_end(key)
+                found[key] = vector
+
+        if disk_misses and self._connection is not None:
+            hashes_by_setting: Dict[Tuple[str, bool], List[str]] = {}
+            for model_name, normalized, text_hash in disk_misses:
+                hashes_by_setting.setdefault((model_name, normalized), []).append(text_hash)
+
+            for (model_name, normalized), text_hashes in hashes_by_setting.items():
+                # stay under SQLite's bound parameter limit
+                for start in range(0, len(text_hashes), 500):
+                    chunk = text_hashes[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = self._connection.execute(
+                        f"SELECT text_hash, vector FROM embeddings "
+                        f"WHERE model_name = ? AND normalized = ? AND text_hash IN ({placeholders})",
+                        [model_name, int(normalized), *chunk],
+                    )
+                    for text_hash, blob in rows:
+                        key = (model_name, normalized, text_hash)
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        found[key] = vector
+                        self._remember(key, vector)
+        return found
+
+    def put_many(self, items: Dict[CacheKey, np.ndarray]):
+        with self._lock:
+            self._put_many(items)
+
+    def _put_many(self, items: Dict[CacheKey, np.ndarray]):
+        for key, vector in items.items():
+            self._remember(key, np.asarray(vector, dtype=np.float32))
+
+        if items and self._connection is not None:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model_name, normalized, text_hash, vector) VALUES (?, ?, ?, ?)",
+                [
+                    (model_name, int(normalized), text_hash, np.asarray(vector, dtype=np.float32).tobytes())
+                    for (model_name, normalized, text_hash), vector in items.items()
+                ],
+            )
+            self._connection.commit()
+
+    def _remember(self, key: CacheKey, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
 
 
 class LocalEmbeddings:
@@ -11,7 +126,9 @@ class LocalEmbeddings:
             self,
             model_name: str = "all-MiniLM-L6-v2",
             device: str = None,
-            normalize_embeddings: bool = True
+            normalize_embeddings: bool = True,
+            cache: Optional[EmbeddingCache] = None,
+            quantize: bool = False
     ):
         """
         Initialize the embeddings model.
@@ -20,12 +137,50 @@ class LocalEmbeddings:
             model_name: Name of the sentence-transformers model to use
             device: Device to run the model on ('cpu', 'cuda', or None for auto-detection)
             normalize_embeddings: Whether to L2-normalize the embeddings
+            cache: Optional EmbeddingCache, so repeated texts skip the model
+            quantize: Use int8 dynamic quantization of the Linear layers. CPU only.
+
+        The model isn't loaded until the first embed call.
         """
+        self.model_name = model_name
+        self.device = device
+        self.normalize_embeddings = normalize_embeddings
+        self.cache = cache
+        self.quantize = quantize
+        self._model = None
+        # embed runs in worker threads, eg concurrent consolidations, which would
+        # otherwise each load their own copy of the model
+        self._model_lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def _load_model(self):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        device = self.device
         if device is None:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
+            device = "cpu" if self.quantize or not torch.cuda.is_available() else "cuda"
+        if self.quantize and device != "cpu":
+            raise ValueError("Quantized embeddings are only supported on cpu")
 
-        self.model = SentenceTransformer(model_name, device=device)
-        self.normalize_embeddings = normalize_embeddings
+        model = SentenceTransformer(self.model_name, device=device)
+        if self.quantize:
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    @property
+    def cache_model_name(self) -> str:
+        """Quantized vectors differ slightly, so they're cached separately."""
+        return f"{self.model_name}:int8" if self.quantize else self.model_name
 
     def embed(self, texts: Union[str, List[str]], batch_size: int = 32) -> np.ndarray:
         """
@@ -42,6 +197,29 @@ class LocalEmbeddings:
         if isinstance(texts, str):
             texts = [texts]
 
+        if self.cache is None:
+            return self._encode(texts, batch_size)
+
+        keys = [
+            EmbeddingCache.make_key(self.cache_model_name, self.normalize_embeddings, text)
+            for text in texts
+        ]
+        vectors_by_key = self.cache.get_many(keys)
+
+        # Only misses go to the model, deduplicated and in one batched call
+        missing_texts_by_key = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors_by_key:
+                missing_texts_by_key.setdefault(key, text)
+        if missing_texts_by_key:
+            new_vectors = self._encode(list(missing_texts_by_key.values()), batch_size)
+            new_vectors_by_key = dict(zip(missing_texts_by_key.keys(), new_vectors))
+            self.cache.put_many(new_vectors_by_key)
+            vectors_by_key.update(new_vectors_by_key)
+
+        return np.stack([vectors_by_key[key] for key in keys]).astype(np.float32, copy=False)
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
         # Generate embeddings
         embeddings = self.model.encode(
             texts,
@@ -64,4 +242,19 @@ class LocalEmbeddings:
             float: Cosine similarity score
         """
         return float(np.dot(embedding1, embedding2) /
-                     (np.linalg.norm(embedding1) * np.linalg.norm(embedding2)))
\ No newline at end of file
+                     (np.linalg.norm(embedding1) * np.linalg.norm(embedding2)))
+
+# int8 dynamic quantization for CPU-only deployments, see bench_embeddings.py for the tradeoff
+USE_QUANTIZED_EMBEDDINGS = False
+
+_shared_embeddings: LocalEmbeddings = None
+
+
+def get_embeddings() -> LocalEmbeddings:
+    """Process-wide LocalEmbeddings, so the model is only loaded once."""
+    global _shared_embeddings
+    if _shared_embeddings is None:
+        _shared_embeddings = LocalEmbeddings(
+            cache=EmbeddingCache(), quantize=USE_QUANTIZED_EMBEDDINGS
+        )
+    return _shared_embeddings
@@ -0,0 +1,117 @@
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set
+
+
+def normalize_alias(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+class AliasMatcher:
+    """Aho-Corasick automaton over entity aliases.
+
+    Resolves names to entity ids with a dict lookup, and finds every alias mentioned in a
+    message in a single pass over its text. Aliases are inserted into the trie as they're
+    added, failure links are rebuilt lazily before the next scan.
+    """
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self._entity_ids_by_alias: Dict[str, List[int]] = {}
+
+        # trie nodes, root is 0
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # lengths of aliases ending at each node, including via failure links once built
+        self._outputs: List[List[int]] = [[]]
+        self._own_outputs: List[List[int]] = [[]]
+        self._is_stale = False
+
+    def add_alias(self, alias: str, entity_id: int):
+        normalized = normalize_alias(alias)
+        if not normalized:
+            return
+        entity_ids = self._entity_ids_by_alias.setdefault(normalized, [])
+        if entity_id in entity_ids:
+            return
+        entity_ids.append(entity_id)
+        if len(entity_ids) > 1:
+            # already in the trie for another entity
+            return
+
+        node = 0
+        for char in normalized:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+                self._own_outputs.append([])
+                self._goto[node][char] = next_node
+            node = next_node
+        self._own_outputs[node].append(len(normalized))
+        self._is_stale = True
+
+    def remove_entity(self, entity_id: int):
+        """Rare, so the whole automaton is rebuilt."""
+        remaining = [
+            (alias, other_id)
+            for alias, entity_ids in self._entity_ids_by_alias.items()
+            for other_id in entity_ids
+            if other_id != entity_id
+        ]
+        self._clear()
+        for alias, other_id in remaining:
+            self.add_alias(alias, other_id)
+
+    def resolve(self, name: str) -> Optional[int]:
+        entity_ids = self._entity_ids_by_alias.get(normalize_alias(name))
+        return entity_ids[0] if entity_ids else None
+
+    def resolve_many(self, names: Iterable[str]) -> Dict[str, Optional[int]]:
+        return {name: self.resolve(name) for name in names}
+
+    def _build_failure_links(self):
+        self._outputs = [list(outputs) for outputs in self._own_outputs]
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                fail_target = self._goto[fallback].get(char, 0)
+                self._fail[child] = fail_target if fail_target != child else 0
+                self._outputs[child].extend(self._outputs[self._fail[child]])
+        self._is_stale = False
+
+    def find_mentions(self, text: str) -> Set[int]:
+        """Ids of entities with an alias appearing in the text as whole words."""
+        if self._is_stale:
+            self._build_failure_links()
+
+        text = normalize_alias(text)
+        mentioned = set()
+        node = 0
+        for end, char in enumerate(text, start=1):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length in self._outputs[node]:
+                start = end - length
+                if _is_word_boundary(text, start - 1) and _is_word_boundary(text, end):
+                    alias = text[start:end]
+                    mentioned.update(self._entity_ids_by_alias[alias])
+        return mentioned
+
+
+_WORD_CHARACTER = re.compile(r"\w")
+
+
+def _is_word_boundary(text: str, index: int) -> bool:
+    return index < 0 or index >= len(text) or not _WORD_CHARACTER.match(text[index])
@@ -3,7 +3,7 @@ from typing import Optional
 
 from src.chat_loop import ChatLoop
 from src.environments.text_adventure.text_adventure import AnchorheadGame
-from src.db import get_engine, get_sessionmaker
+from src.db import get_db_factory
 from sqlalchemy.orm import Session
 
 
@@ -58,8 +58,7 @@ async def text_adventure_loop(
 
 
 async def main():
-    engine = get_engine()
-    Session = get_sessionmaker(engine)
+    Session = get_db_factory()
 
     with Session() as session:
         await text_adventure_loop(session=session, headless=False, human_observer=True)
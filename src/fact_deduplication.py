@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+from typing import Dict
+
+import numpy as np
+
+from src.db import Fact
+from src.knowledge_snapshot import KnowledgeSnapshot
+
+# cosine similarity above which two facts are taken to say the same thing
+FACT_DUPLICATE_SIMILARITY = 0.92
+
+
+@dataclass
+class FactDuplicates:
+    # new fact index -> id of the existing fact it repeats
+    existing: Dict[int, int] = field(default_factory=dict)
+    # new fact index -> index of the kept new fact it folds into: the earliest new fact it
+    # repeats, or the first new fact to claim the same existing fact
+    within_batch: Dict[int, int] = field(default_factory=dict)
+
+
+def find_duplicate_facts(
+    snapshot: KnowledgeSnapshot,
+    vectors: np.ndarray,
+    threshold: float = FACT_DUPLICATE_SIMILARITY,
+) -> FactDuplicates:
+    """Match a batch of new facts' embeddings against each other and every current fact.
+
+    Two matrix products, no per-pair loop. Each existing fact is superseded at most once,
+    later new facts matching it fold into the first one that claimed it.
+    """
+    duplicates = FactDuplicates()
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not len(vectors):
+        return duplicates
+    normalized = vectors / np.maximum(
+        np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+    )
+
+    batch_similarities = normalized @ normalized.T
+    for j in range(1, len(normalized)):
+        earlier = np.flatnonzero(batch_similarities[j, :j] >= threshold)
+        if earlier.size:
+            # a chain of near duplicates folds into its first fact, the one kept
+            first = int(earlier[0])
+            duplicates.within_batch[j] = duplicates.within_batch.get(first, first)
+
+    item_ids, similarities = snapshot.embedding_index.similarity_matrix(normalized)
+    if not similarities.size:
+        return duplicates
+    fact_ids = np.fromiter(snapshot.facts.keys(), dtype=np.int64)
+    similarities = np.where(np.isin(item_ids, fact_ids), similarities, -np.inf)
+    best_positions = similarities.argmax(axis=1)
+    best_similarities = similarities[np.arange(len(normalized)), best_positions]
+
+    claimed_by = {}
+    for j in np.flatnonzero(best_similarities >= threshold):
+        j = int(j)
+        existing_id = int(item_ids[best_positions[j]])
+        if j in duplicates.within_batch:
+            continue
+        if existing_id in claimed_by:
+            # the claimer is never folded itself, so it is already the root of its chain
+            duplicates.within_batch[j] = claimed_by[existing_id]
+            continue
+        claimed_by[existing_id] = j
+        duplicates.existing[j] = existing_id
+    return duplicates
+
+
+def supersede_fact(duplicate: Fact, fact: Fact, message_index: int):
+    """Retire an existing fact in favour of a new one saying the same thing.
+
+    The new fact takes over the duplicate's entity and summary associations and its usage
+    aggregates, and counts as the same fact updated now.
+    """
+    fact.importance = max(fact.importance, duplicate.importance)
+    fact.salience = max(fact.salience, duplicate.salience)
+    fact.created_at_message_index = duplicate.created_at_message_index
+    fact.updated_at_message_index = message_index
+
+    fact.entities = list(
+        {e.id: e for e in [*duplicate.entities, *fact.entities]}.values()
+    )
+    fact.message_summaries = list(
+        {
+            s.id: s for s in [*duplicate.message_summaries, *fact.message_summaries]
+        }.values()
+    )
+    duplicate.entities = []
+    duplicate.message_summaries = []
+
+    fact.num_times_provided = (fact.num_times_provided or 0) + (
+        duplicate.num_times_provided or 0
+    )
+    fact.num_times_useful = (fact.num_times_useful or 0) + (
+        duplicate.num_times_useful or 0
+    )
+    fact.usefulness_sum = (fact.usefulness_sum or 0) + (duplicate.usefulness_sum or 0)
+    fact.last_provided_message_index = duplicate.last_provided_message_index
+    duplicate.retired_by = fact.id
@@ -0,0 +1,81 @@
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+# Every llm call, from completion and the pydantic_ai agents alike, goes through one
+# process-wide set of keep-alive connections, so only the first request to a host pays
+# for DNS, TCP and TLS setup.
+MAX_CONNECTIONS_PER_HOST = 16
+KEEPALIVE_EXPIRY_SECONDS = 60
+CONNECT_TIMEOUT_SECONDS = 10
+DEFAULT_TIMEOUT_SECONDS = 60
+
+
+class SharedPoolTransport(httpx.AsyncBaseTransport):
+    """Sends requests through a connection pool per host, each limited to max_connections_per_host.
+
+    Pools are created on a host's first request and dropped by close_pools. Clients wrapping
+    the transport hold no connections themselves, so they can be made at import time and
+    keep working after the pools are closed, eg across asyncio.run calls.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+        keepalive_expiry: float = KEEPALIVE_EXPIRY_SECONDS,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_connections_per_host,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._pools: Dict[
+            Tuple[bytes, bytes, Optional[int]], httpx.AsyncHTTPTransport
+        ] = {}
+
+    @property
+    def num_pools(self) -> int:
+        return len(self._pools)
+
+    def _pool_for(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        key = (url.raw_scheme, url.raw_host, url.port)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = httpx.AsyncHTTPTransport(limits=self.limits)
+            self._pools[key] = pool
+        return pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._pool_for(request.url).handle_async_request(request)
+
+    async def close_pools(self):
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            await pool.aclose()
+
+    async def aclose(self):
+        await self.close_pools()
+
+
+_shared_transport: Optional[SharedPoolTransport] = None
+_shared_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Process-wide client on the shared pools. Never closed, see close_http_pool."""
+    global _shared_transport, _shared_http_client
+    if _shared_http_client is None:
+        _shared_transport = SharedPoolTransport()
+        _shared_http_client = httpx.AsyncClient(
+            transport=_shared_transport,
+            timeout=httpx.Timeout(
+                DEFAULT_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS
+            ),
+        )
+    return _shared_http_client
+
+
+async def close_http_pool():
+    """Close the shared connections. The next request opens new ones."""
+    if _shared_transport is not None:
+        await _shared_transport.close_pools()
@@ -0,0 +1,289 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session, selectinload
+
+from src.db import (
+    ContextItem,
+    Entity,
+    EntityAlias,
+    Fact,
+    MessageSummary,
+)
+from src.embeddings import LocalEmbeddings, get_embeddings
+from src.entity_matching import AliasMatcher
+
+SNAPSHOT_SESSION_KEY = "knowledge_snapshot"
+# items made before embeddings were stored are embedded on load, this many at a time
+EMBEDDING_BACKFILL_BATCH_SIZE = 256
+
+
+def embed_context_items(
+    items: List[ContextItem], embeddings: Optional[LocalEmbeddings] = None
+):
+    """Embed item bodies in one batch and store them on the items, to be persisted on commit."""
+    items = [item for item in items if item is not None]
+    if not items:
+        return
+    embeddings = embeddings or get_embeddings()
+    vectors = embeddings.embed([item.body for item in items])
+    for item, vector in zip(items, vectors):
+        item.set_embedding(vector)
+
+
+class EmbeddingIndex:
+    """In-memory (num_items, dim) matrix of context item embeddings.
+
+    Vectors are pushed in as items change. The pre-normalized matrix is rebuilt lazily,
+    so a single matrix product gives cosine similarity against every item.
+    """
+
+    def __init__(self):
+        self._vectors: Dict[int, np.ndarray] = {}
+        self._is_stale = False
+        self._item_ids = np.empty(0, dtype=np.int64)
+        self._positions: Dict[int, int] = {}
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def set(self, item_id: int, vector: np.ndarray):
+        self._vectors[item_id] = np.asarray(vector, dtype=np.float32)
+        self._is_stale = True
+
+    def remove(self, item_ids: Iterable[int]):
+        for item_id in item_ids:
+            if self._vectors.pop(item_id, None) is not None:
+                self._is_stale = True
+
+    @property
+    def item_ids(self) -> np.ndarray:
+        self._rebuild_if_stale()
+        return self._item_ids
+
+    @property
+    def matrix(self) -> np.ndarray:
+        self._rebuild_if_stale()
+        return self._matrix
+
+    def _rebuild_if_stale(self):
+        if not self._is_stale:
+            return
+        self._is_stale = False
+        if not self._vectors:
+            self._item_ids = np.empty(0, dtype=np.int64)
+            self._positions = {}
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+            return
+        self._item_ids = np.fromiter(self._vectors.keys(), dtype=np.int64)
+        self._positions = {item_id: i for i, item_id in enumerate(self._vectors)}
+        matrix = np.stack(list(self._vectors.values()))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self._matrix = matrix / np.maximum(norms, 1e-12)
+
+    def top_k(self, query_vector: np.ndarray, k: int) -> Tuple[List[int], np.ndarray]:
+        """Ids of the k most similar items, and their cosine similarities."""
+        if not len(self):
+            return [], np.empty(0, dtype=np.float32)
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+        scores = self.matrix @ query_vector
+        if k < len(scores):
+            candidate_indices = np.argpartition(-scores, k)[:k]
+        else:
+            candidate_indices = np.arange(len(scores))
+        ordered = candidate_indices[np.argsort(-scores[candidate_indices])]
+        return self.item_ids[ordered].tolist(), scores[ordered]
+
+    def similarity_matrix(
+        self, query_vectors: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Cosine similarity of every query vector against every item, (num_queries, num_items), and the items' ids."""
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        if not len(self):
+            return self.item_ids, np.empty((len(query_vectors), 0), dtype=np.float32)
+        norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        query_vectors = query_vectors / np.maximum(norms, 1e-12)
+        return self.item_ids, query_vectors @ self.matrix.T
+
+    def similarities_for(
+        self, query_vector: np.ndarray, item_ids: List[int]
+    ) -> np.ndarray:
+        """Cosine similarity of specific items, 0 for items without an embedding."""
+        self._rebuild_if_stale()
+        similarities = np.zeros(len(item_ids), dtype=np.float32)
+        positions = [self._positions.get(item_id) for item_id in item_ids]
+        known = [i for i, position in enumerate(positions) if position is not None]
+        if known:
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+            rows = self._matrix[[positions[i] for i in known]]
+            similarities[known] = rows @ query_vector
+        return similarities
+
+
+class KnowledgeSnapshot:
+    """Long-lived in-memory view of the current facts, entities and message summaries.
+
+    Loaded from the db once, then kept current by the session's flush and commit
+    events, so building a turn's context only queries the db for lexical search.
+    Retired items are dropped from the snapshot. A rollback expires every loaded object,
+    so the snapshot is reloaded in one go before its next use, see get_knowledge_snapshot.
+    """
+
+    def __init__(self):
+        self._reset()
+        self.needs_reload = False
+
+    def _reset(self):
+        self.facts: Dict[int, Fact] = {}
+        self.message_summaries: Dict[int, MessageSummary] = {}
+        self.entities: Dict[int, Entity] = {}
+        self.embedding_index = EmbeddingIndex()
+        self.alias_matcher = AliasMatcher()
+        self._item_ids_by_entity_id: Dict[int, Set[int]] = {}
+        self._entity_ids_by_item_id: Dict[int, Set[int]] = {}
+
+        self._pending_changes: Set[object] = set()
+        self._pending_deletes: Set[object] = set()
+
+    def load(self, session: Session):
+        # eager loads the aliases that render entities, so nothing is lazy loaded per row
+        facts = (
+            session.query(Fact)
+            .options(selectinload(Fact.entities).selectinload(Entity.aliases))
+            .filter(Fact.retired_by.is_(None))
+        )
+        message_summaries = (
+            session.query(MessageSummary)
+            .options(selectinload(MessageSummary.entities).selectinload(Entity.aliases))
+            .filter(MessageSummary.retired_by.is_(None))
+        )
+        entities = session.query(Entity).options(selectinload(Entity.aliases))
+        items = [*facts, *message_summaries]
+        self.embed_missing(session, items)
+        self.apply_changes(changed=[*items, *entities])
+
+    @staticmethod
+    def embed_missing(session: Session, items: List[ContextItem]):
+        """Embed and store items without an embedding, so embedding search can find them.
+
+        Only items from a db made before embeddings were stored are missing one.
+        """
+        missing = [item for item in items if item.embedding is None]
+        if not missing:
+            return
+        print(f"Embedding {len(missing)} context items stored without an embedding")
+        for start in range(0, len(missing), EMBEDDING_BACKFILL_BATCH_SIZE):
+            embed_context_items(missing[start : start + EMBEDDING_BACKFILL_BATCH_SIZE])
+            session.commit()
+
+    def attach(self, session: Session):
+        """Follow the session's commits. Changes are collected per flush and applied once committed."""
+        event.listen(session, "after_flush", self._on_after_flush)
+        event.listen(session, "after_commit", self._on_after_commit)
+        event.listen(session, "after_soft_rollback", self._on_after_rollback)
+
+    def _on_after_flush(self, session: Session, flush_context):
+        self._pending_changes.update(session.new)
+        self._pending_changes.update(session.dirty)
+        self._pending_deletes.update(session.deleted)
+
+    def _on_after_commit(self, session: Session):
+        changed, deleted = self._pending_changes, self._pending_deletes
+        self._pending_changes, self._pending_deletes = set(), set()
+        self.apply_changes(changed=changed, deleted=deleted)
+
+    def _on_after_rollback(self, session: Session, previous_transaction):
+        self._pending_changes.clear()
+        self._pending_deletes.clear()
+        # otherwise each expired object would be refreshed with its own query on use
+        self.needs_reload = True
+
+    def reload(self, session: Session):
+        self._reset()
+        self.needs_reload = False
+        self.load(session)
+
+    def apply_changes(
+        self, changed: Iterable[object] = (), deleted: Iterable[object] = ()
+    ):
+        """Explicit change feed, also used by the session events."""
+        for obj in changed:
+            if isinstance(obj, EntityAlias):
+                obj = obj.entity
+                if obj is None:
+                    continue
+
+            if isinstance(obj, Entity):
+                self.entities[obj.id] = obj
+                for alias in obj.aliases:
+                    self.alias_matcher.add_alias(alias.alias, obj.id)
+            elif isinstance(obj, (Fact, MessageSummary)):
+                if obj.retired_by is not None:
+                    self._remove_item(obj)
+                    continue
+                self._items_for(obj)[obj.id] = obj
+                self._index_item_entities(obj)
+                if obj.embedding is not None:
+                    self.embedding_index.set(obj.id, obj.embedding_vector)
+
+        for obj in deleted:
+            if isinstance(obj, Entity):
+                self.entities.pop(obj.id, None)
+                self.alias_matcher.remove_entity(obj.id)
+            elif isinstance(obj, (Fact, MessageSummary)):
+                self._remove_item(obj)
+
+    def _index_item_entities(self, item: ContextItem):
+        self._unindex_item_entities(item.id)
+        entity_ids = {entity.id for entity in item.entities}
+        self._entity_ids_by_item_id[item.id] = entity_ids
+        for entity_id in entity_ids:
+            self._item_ids_by_entity_id.setdefault(entity_id, set()).add(item.id)
+
+    def _unindex_item_entities(self, item_id: int):
+        for entity_id in self._entity_ids_by_item_id.pop(item_id, ()):
+            self._item_ids_by_entity_id[entity_id].discard(item_id)
+
+    def _items_for(self, item: ContextItem) -> Dict[int, ContextItem]:
+        if isinstance(item, Fact):
+            return self.facts
+        return self.message_summaries
+
+    def _remove_item(self, item: ContextItem):
+        self._items_for(item).pop(item.id, None)
+        self._unindex_item_entities(item.id)
+        self.embedding_index.remove([item.id])
+
+    def get_item(self, item_id: int):
+        return self.facts.get(item_id) or self.message_summaries.get(item_id)
+
+    def resolve_entities(self, names: Iterable[str]) -> Dict[str, Optional[Entity]]:
+        """Entities by alias, without a query per name. Unknown names map to None."""
+        return {
+            name: self.entities.get(entity_id) if entity_id is not None else None
+            for name, entity_id in self.alias_matcher.resolve_many(names).items()
+        }
+
+    def find_mentioned_entities(self, text: str) -> List[Entity]:
+        entity_ids = self.alias_matcher.find_mentions(text)
+        return [self.entities[i] for i in sorted(entity_ids) if i in self.entities]
+
+    def get_item_ids_for_entity(self, entity_id: int) -> Set[int]:
+        return self._item_ids_by_entity_id.get(entity_id, set())
+
+
+def get_knowledge_snapshot(session: Session) -> KnowledgeSnapshot:
+    """The session's snapshot, loaded and attached on first use, and reloaded after a rollback."""
+    snapshot = session.info.get(SNAPSHOT_SESSION_KEY)
+    if snapshot is None:
+        snapshot = KnowledgeSnapshot()
+        snapshot.load(session)
+        snapshot.attach(session)
+        session.info[SNAPSHOT_SESSION_KEY] = snapshot
+    elif snapshot.needs_reload:
+        snapshot.reload(session)
+    return snapshot
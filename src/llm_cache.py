@@ -0,0 +1,191 @@
+import enum
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, List, Optional
+
+from pydantic_ai.messages import ModelMessage, ModelMessagesTypeAdapter, ModelResponse
+from pydantic_ai.models import Model, ModelRequestParameters
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.usage import Usage
+
+from src.paths import PROJECT_ROOT
+
+
+class LLMCacheMode(enum.Enum):
+    # serve recorded responses, calling the llm and recording on a miss
+    RECORD = "record"
+    # only serve recorded responses, a miss is an error
+    REPLAY = "replay"
+    # always call the llm, the cache is neither read nor written
+    PASSTHROUGH = "passthrough"
+
+
+LLM_CACHE_MODE = LLMCacheMode(os.environ.get("LLM_CACHE_MODE", "passthrough"))
+LLM_CACHE_PATH = str(PROJECT_ROOT / "llm_cache.db")
+
+# parts of a request that change between otherwise identical calls
+VOLATILE_FIELDS = {"timestamp", "tool_call_id"}
+
+
+class LLMCacheMiss(Exception):
+    pass
+
+
+def normalize_for_key(value: Any) -> Any:
+    """Drop volatile fields and whitespace differences that don't change what the llm sees."""
+    if isinstance(value, dict):
+        return {
+            key: normalize_for_key(item)
+            for key, item in value.items()
+            if key not in VOLATILE_FIELDS
+        }
+    if isinstance(value, (list, tuple)):
+        return [normalize_for_key(item) for item in value]
+    if isinstance(value, str):
+        lines = value.replace("\r\n", "\n").split("\n")
+        return "\n".join(line.rstrip() for line in lines).strip()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+class LLMResponseCache:
+    """Recorded llm responses in an SQLite table, keyed by a hash of the request.
+
+    Keys cover the model, the normalized messages or prompt, and the result schema, so a
+    changed prompt or result model never gets a stale response.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[str] = LLM_CACHE_PATH,
+        mode: LLMCacheMode = LLMCacheMode.RECORD,
+    ):
+        """
+        Args:
+            db_path: SQLite file to keep responses in, or None for memory only
+            mode: Whether lookups record misses, fail on misses, or are skipped
+        """
+        self.mode = mode
+        self._lock = threading.RLock()
+        self._connection = None
+        if mode != LLMCacheMode.PASSTHROUGH:
+            self._connection = sqlite3.connect(
+                db_path or ":memory:", check_same_thread=False
+            )
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS llm_responses (
+                    request_hash TEXT PRIMARY KEY,
+                    model_name TEXT NOT NULL,
+                    response TEXT NOT NULL
+                )""")
+            self._connection.commit()
+
+    @staticmethod
+    def make_key(model_name: str, request: Any, result_schema: Any = None) -> str:
+        normalized = json.dumps(
+            {
+                "model": model_name,
+                "request": normalize_for_key(request),
+                "result_schema": normalize_for_key(result_schema),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """The recorded response, None if there isn't one to use.
+
+        Raises LLMCacheMiss in replay mode rather than letting the caller hit the network.
+        """
+        if self.mode == LLMCacheMode.PASSTHROUGH:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response FROM llm_responses WHERE request_hash = ?", (key,)
+            ).fetchone()
+        if row is None and self.mode == LLMCacheMode.REPLAY:
+            raise LLMCacheMiss(f"No recorded response for request {key}")
+        return row[0] if row else None
+
+    def put(self, key: str, model_name: str, response: str):
+        if self.mode != LLMCacheMode.RECORD:
+            return
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_responses (request_hash, model_name, response) VALUES (?, ?, ?)",
+                (key, model_name, response),
+            )
+            self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class CachedModel(WrapperModel):
+    """pydantic_ai model answering from an LLMResponseCache before calling the wrapped model.
+
+    The result tools are part of the request parameters, so the key covers the agent's
+    result schema. Cached responses report no usage, as they cost nothing.
+    """
+
+    def __init__(self, wrapped: Model, cache: Optional[LLMResponseCache] = None):
+        super().__init__(wrapped)
+        self._cache = cache
+
+    @property
+    def cache(self) -> LLMResponseCache:
+        # looked up at request time, so the mode can be set before the first call
+        return self._cache or get_llm_cache()
+
+    async def request(
+        self,
+        messages: List[ModelMessage],
+        model_settings: Optional[ModelSettings],
+        model_request_parameters: ModelRequestParameters,
+    ) -> tuple[ModelResponse, Usage]:
+        cache = self.cache
+        if cache.mode == LLMCacheMode.PASSTHROUGH:
+            return await self.wrapped.request(
+                messages, model_settings, model_request_parameters
+            )
+
+        key = cache.make_key(
+            self.model_name,
+            ModelMessagesTypeAdapter.dump_python(messages, mode="json"),
+            [
+                [tool.name, tool.parameters_json_schema]
+                for tool in model_request_parameters.result_tools
+                + model_request_parameters.function_tools
+            ],
+        )
+        recorded = cache.get(key)
+        if recorded is not None:
+            return ModelMessagesTypeAdapter.validate_json(recorded)[0], Usage()
+
+        response, usage = await self.wrapped.request(
+            messages, model_settings, model_request_parameters
+        )
+        cache.put(
+            key,
+            self.model_name,
+            ModelMessagesTypeAdapter.dump_json([response]).decode("utf-8"),
+        )
+        return response, usage
+
+
+_shared_llm_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """Process-wide cache in LLM_CACHE_MODE."""
+    global _shared_llm_cache
+    if _shared_llm_cache is None:
+        _shared_llm_cache = LLMResponseCache(mode=LLM_CACHE_MODE)
+    return _shared_llm_cache
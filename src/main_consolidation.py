@@ -1,11 +1,10 @@
 from src.chat_loop import conversation_loop
-from src.consolidation import should_consolidate, consolidate
+from src.consolidation import should_consolidate, consolidate, ingest_transcript
 from src.conversation import Conversation
 
 from src.db import get_db_factory
 from src.dev_load_fulminate import load_fulminate
 
-
 # Make a fake conversation
 # Run consolidate
 
@@ -36,9 +35,10 @@ async def main():
     SessionLocal = get_db_factory()
     with SessionLocal() as session:
         fulminate_messages = load_fulminate()
-        await consolidate_fulminate_no_context(
-            session=session, messages=fulminate_messages
-        )
+        # windows are consolidated concurrently, rather than one at a time with
+        # consolidate_fulminate_no_context
+        jobs = await ingest_transcript(session=session, messages=fulminate_messages)
+        print("done", len(jobs))
 
 
 if __name__ == "__main__":
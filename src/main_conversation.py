@@ -1,11 +1,10 @@
 from pydantic_ai import Agent
-from pydantic_ai.models.openai import OpenAIModel
-from pydantic_ai.providers.openai import OpenAIProvider
 
 from src.chat_loop import conversation_loop
 
-from src.conversation import MODEL, OPENROUTER_API_KEY
+from src.conversation import make_llm_model
 from src.db import get_db_factory
+from src.rate_limiting import Priority
 
 
 async def main():
@@ -15,14 +14,7 @@ async def main():
 
 
 def little_main():
-    model = OpenAIModel(
-        MODEL.replace("openrouter/", ""),
-        provider=OpenAIProvider(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY,
-        ),
-    )
-    agent = Agent(model)
+    agent = Agent(make_llm_model(Priority.INTERACTIVE))
     result = agent.run_sync(
         "What are two syllable words related to 'soul', possibly a prefix"
     )
@@ -25,7 +25,9 @@ async def get_context_after_consolidation(session, messages):
         conversation.add_message(message=message)
 
         if message.role == Role.USER:
-            last_context = get_assistant_context(session)
+            last_context = get_assistant_context(
+                session, recent_messages=conversation.messages
+            )
 
         elif message.role == Role.ASSISTANT:
             await evaluate_context(
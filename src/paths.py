@@ -0,0 +1,13 @@
+from pathlib import Path
+
+
+def find_project_root() -> Path:
+    """The nearest parent holding .git, or the one above src when there isn't one."""
+    parents = Path(__file__).resolve().parents
+    for parent in parents:
+        if (parent / ".git").exists():
+            return parent
+    return parents[1]
+
+
+PROJECT_ROOT = find_project_root()
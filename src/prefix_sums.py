@@ -0,0 +1,57 @@
+from typing import List, Optional
+
+
+class FenwickTree:
+    """Prefix sums over a growable array of non-negative numbers.
+
+    Appending, updating a value, summing a prefix and finding the shortest prefix
+    reaching a target sum are all O(log n).
+    """
+
+    def __init__(self):
+        # 1-based, node i covers the values (i - lowbit(i), i]
+        self._tree: List[int] = [0]
+        self.total = 0
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def append(self, value: int):
+        i = len(self._tree)
+        covered_from = i - (i & -i)
+        self._tree.append(
+            value + self.prefix_sum(i - 1) - self.prefix_sum(covered_from)
+        )
+        self.total += value
+
+    def add(self, index: int, delta: int):
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+        self.total += delta
+
+    def prefix_sum(self, length: int) -> int:
+        """Sum of the first length values."""
+        total = 0
+        i = length
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def search(self, target: int) -> Optional[int]:
+        """Length of the shortest prefix summing to at least target, None if the total is short."""
+        if target <= 0:
+            return 0
+        if self.total < target:
+            return None
+        length = 0
+        step = 1 << (len(self).bit_length() - 1) if len(self) else 0
+        while step:
+            next_length = length + step
+            if next_length <= len(self) and self._tree[next_length] < target:
+                length = next_length
+                target -= self._tree[next_length]
+            step >>= 1
+        return length + 1
@@ -0,0 +1,275 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from src.db import ContextItem, UsageRecord
+
+FEATURE_NAMES = (
+    "log_age",
+    "log_age_since_updated",
+    "importance",
+    "salience",
+    "similarity",
+    "log_times_provided",
+    "mean_usefulness",
+)
+
+MIN_TRAINING_RECORDS = 200
+RETRAIN_EVERY_NUM_RECORDS = 100
+
+
+def build_feature_matrix(
+    current_message_index,
+    created_at_message_index,
+    updated_at_message_index,
+    importance,
+    salience,
+    similarity,
+    times_provided,
+    usefulness_sum,
+) -> np.ndarray:
+    """Turn per-item arrays into a (num_items, len(FEATURE_NAMES)) matrix.
+
+    Shared by training and scoring so both see identical transforms.
+    updated_at_message_index may contain nan for items never updated.
+    """
+    current_message_index = np.asarray(current_message_index, dtype=np.float64)
+    created = np.asarray(created_at_message_index, dtype=np.float64)
+    updated = np.asarray(updated_at_message_index, dtype=np.float64)
+    updated = np.where(np.isnan(updated), created, updated)
+    times_provided = np.asarray(times_provided, dtype=np.float64)
+    usefulness_sum = np.asarray(usefulness_sum, dtype=np.float64)
+
+    # usefulness is 0-2, normalized to 0-1. Never provided items get a neutral prior.
+    mean_usefulness = np.divide(
+        usefulness_sum,
+        2 * times_provided,
+        out=np.full_like(usefulness_sum, 0.5),
+        where=times_provided > 0,
+    )
+
+    return np.column_stack(
+        [
+            np.log1p(np.maximum(current_message_index - created, 0)),
+            np.log1p(np.maximum(current_message_index - updated, 0)),
+            np.asarray(importance, dtype=np.float64),
+            np.asarray(salience, dtype=np.float64),
+            np.asarray(similarity, dtype=np.float64),
+            np.log1p(times_provided),
+            mean_usefulness,
+        ]
+    )
+
+
+def extract_features(
+    items: List[ContextItem], similarities, current_message_index: int
+) -> np.ndarray:
+    created, updated, importance, salience = [], [], [], []
+    times_provided, usefulness_sum = [], []
+    for item in items:
+        created.append(item.created_at_message_index)
+        updated.append(
+            np.nan
+            if item.updated_at_message_index is None
+            else item.updated_at_message_index
+        )
+        importance.append(item.importance)
+        salience.append(item.salience)
+        times_provided.append(item.times_provided)
+        usefulness_sum.append(item.usefulness_sum or 0)
+
+    return build_feature_matrix(
+        current_message_index=current_message_index,
+        created_at_message_index=created,
+        updated_at_message_index=updated,
+        importance=importance,
+        salience=salience,
+        similarity=similarities,
+        times_provided=times_provided,
+        usefulness_sum=usefulness_sum,
+    )
+
+
+def heuristic_scores(features: np.ndarray) -> np.ndarray:
+    """Hand weighted stand-in until there are enough usage records to train on."""
+    column = {name: features[:, i] for i, name in enumerate(FEATURE_NAMES)}
+    return (
+        0.5 * column["similarity"]
+        + 0.25 * (column["importance"] + column["salience"]) / 20
+        + 0.25 * column["mean_usefulness"]
+    )
+
+
+def load_training_data(
+    session: Session,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Features of each item as of each usage record, with normalized usefulness as the target.
+
+    Past usages only count records before the one being predicted.
+    """
+    rows = (
+        session.query(
+            UsageRecord.context_item_id,
+            UsageRecord.created_at_message_index,
+            UsageRecord.usefulness,
+            UsageRecord.similarity,
+            ContextItem.created_at_message_index,
+            ContextItem.updated_at_message_index,
+            ContextItem.importance,
+            ContextItem.salience,
+        )
+        .join(ContextItem, UsageRecord.context_item_id == ContextItem.id)
+        .order_by(
+            UsageRecord.context_item_id,
+            UsageRecord.created_at_message_index,
+            UsageRecord.id,
+        )
+        .all()
+    )
+
+    columns = {
+        name: []
+        for name in (
+            "current",
+            "created",
+            "updated",
+            "importance",
+            "salience",
+            "similarity",
+            "times_provided",
+            "usefulness_sum",
+        )
+    }
+    targets = []
+    previous_item_id = None
+    times_provided = usefulness_sum = 0
+    for (
+        item_id,
+        record_index,
+        usefulness,
+        similarity,
+        created,
+        updated,
+        importance,
+        salience,
+    ) in rows:
+        if item_id != previous_item_id:
+            previous_item_id = item_id
+            times_provided = usefulness_sum = 0
+
+        # records from before similarity was stored can't be used as training rows
+        if similarity is not None:
+            columns["current"].append(record_index)
+            columns["created"].append(created)
+            columns["updated"].append(np.nan if updated is None else updated)
+            columns["importance"].append(importance)
+            columns["salience"].append(salience)
+            columns["similarity"].append(similarity)
+            columns["times_provided"].append(times_provided)
+            columns["usefulness_sum"].append(usefulness_sum)
+            targets.append(usefulness / 2)
+
+        times_provided += 1
+        usefulness_sum += usefulness
+
+    features = build_feature_matrix(
+        current_message_index=columns["current"],
+        created_at_message_index=columns["created"],
+        updated_at_message_index=columns["updated"],
+        importance=columns["importance"],
+        salience=columns["salience"],
+        similarity=columns["similarity"],
+        times_provided=columns["times_provided"],
+        usefulness_sum=columns["usefulness_sum"],
+    )
+    return features, np.asarray(targets, dtype=np.float64)
+
+
+def fit_model(features: np.ndarray, targets: np.ndarray) -> Optional[Pipeline]:
+    """Logistic regression on soft labels.
+
+    Each record appears once as a positive weighted by its normalized usefulness,
+    and once as a negative weighted by the remainder.
+    """
+    if len(targets) < MIN_TRAINING_RECORDS:
+        return None
+    doubled_features = np.vstack([features, features])
+    labels = np.concatenate([np.ones(len(targets)), np.zeros(len(targets))])
+    weights = np.concatenate([targets, 1 - targets])
+    if not weights[labels == 1].any() or not weights[labels == 0].any():
+        return None
+
+    model = make_pipeline(StandardScaler(), LogisticRegression())
+    model.fit(doubled_features, labels, logisticregression__sample_weight=weights)
+    return model
+
+
+class UsefulnessRanker:
+    """Scores candidate context items by predicted usefulness, retraining as usage records accrue."""
+
+    def __init__(self):
+        self.model: Optional[Pipeline] = None
+        self.num_records_trained_on = 0
+        # counted once, then kept current by schedule_retrain's callers
+        self.num_records: Optional[int] = None
+        self._retrain_task: Optional[asyncio.Task] = None
+
+    def score(self, features: np.ndarray) -> np.ndarray:
+        if not len(features):
+            return np.empty(0)
+        model = self.model
+        if model is None:
+            return heuristic_scores(features)
+        return model.predict_proba(features)[:, 1]
+
+    def train(self, session: Session):
+        num_records = session.query(func.count(UsageRecord.id)).scalar()
+        features, targets = load_training_data(session)
+        model = fit_model(features, targets)
+        if model is not None:
+            self.model = model
+        self.num_records_trained_on = num_records
+
+    def schedule_retrain(self, session: Session, num_new_records: int = 0):
+        """Retrain in a worker thread once enough new records exist.
+
+        Called at startup, then by ContextEvaluationQueue after it commits num_new_records,
+        so records are only counted in the db once and never on a chat turn.
+        Training data is read here on the caller's thread, as the session isn't thread safe.
+        """
+        if self.num_records is None:
+            self.num_records = session.query(func.count(UsageRecord.id)).scalar()
+        else:
+            self.num_records += num_new_records
+        if self._retrain_task and not self._retrain_task.done():
+            return
+        if self.num_records - self.num_records_trained_on < RETRAIN_EVERY_NUM_RECORDS:
+            return
+        features, targets = load_training_data(session)
+        self._retrain_task = asyncio.create_task(
+            self._retrain(features, targets, self.num_records)
+        )
+
+    async def _retrain(
+        self, features: np.ndarray, targets: np.ndarray, num_records: int
+    ):
+        model = await asyncio.to_thread(fit_model, features, targets)
+        if model is not None:
+            self.model = model
+        self.num_records_trained_on = num_records
+
+
+_shared_ranker: Optional[UsefulnessRanker] = None
+
+
+def get_ranker() -> UsefulnessRanker:
+    global _shared_ranker
+    if _shared_ranker is None:
+        _shared_ranker = UsefulnessRanker()
+    return _shared_ranker
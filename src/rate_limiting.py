@@ -0,0 +1,264 @@
+import asyncio
+import enum
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from pydantic_ai.messages import ModelMessage, ModelMessagesTypeAdapter, ModelResponse
+from pydantic_ai.models import Model, ModelRequestParameters
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.usage import Usage
+
+from src.tokens import count_tokens
+
+# Every llm call shares the account's quota, so they all wait on one limiter.
+# Quota refills continuously, and up to RATE_LIMIT_BURST_SECONDS worth can be used at once.
+RATE_LIMIT_REQUESTS_PER_MINUTE = int(
+    os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE", "60")
+)
+RATE_LIMIT_TOKENS_PER_MINUTE = int(
+    os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE", "200000")
+)
+RATE_LIMIT_BURST_SECONDS = 60
+# reserved for the response before its actual size is known
+ESTIMATED_COMPLETION_TOKENS = 500
+
+
+class Priority(enum.IntEnum):
+    """Lower values go first. A waiting call is never overtaken by a lower priority one."""
+
+    INTERACTIVE = 0
+    CONSOLIDATION = 1
+    EVALUATION = 2
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, per_second: float):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self._updated_at = time.monotonic()
+
+    @classmethod
+    def per_minute(cls, per_minute: float, burst_seconds: float) -> "TokenBucket":
+        per_second = per_minute / 60
+        # at least one call's worth, or nothing could ever be granted
+        return cls(max(per_second * burst_seconds, 1), per_second)
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self._updated_at) * self.per_second
+        )
+        self._updated_at = now
+
+    def seconds_until(self, amount: float) -> float:
+        """0 if amount is available now. The level may be negative after a correction."""
+        return max(amount - self.level, 0.0) / self.per_second
+
+
+@dataclass
+class PriorityStats:
+    num_acquired: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+
+    @property
+    def mean_wait_seconds(self) -> float:
+        return self.wait_seconds / self.num_acquired if self.num_acquired else 0.0
+
+
+class PriorityRateLimiter:
+    """Token buckets for requests and tokens per minute, handed out in priority order.
+
+    Callers reserve an estimate of their tokens up front and correct it once the response
+    says how many were used, see Permit.record_usage.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = RATE_LIMIT_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = RATE_LIMIT_TOKENS_PER_MINUTE,
+        burst_seconds: float = RATE_LIMIT_BURST_SECONDS,
+    ):
+        self.requests = TokenBucket.per_minute(requests_per_minute, burst_seconds)
+        self.tokens = TokenBucket.per_minute(tokens_per_minute, burst_seconds)
+        self.stats: Dict[Priority, PriorityStats] = {
+            priority: PriorityStats() for priority in Priority
+        }
+        # (priority, arrival order, tokens, future)
+        self._queue: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def acquire(self, priority: Priority, num_tokens: float):
+        # a call bigger than the bucket would never fit, it waits for a full one instead
+        num_tokens = min(num_tokens, self.tokens.capacity)
+        stats = self.stats[priority]
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._queue, (priority, next(self._arrivals), num_tokens, future)
+        )
+        stats.queue_depth += 1
+        stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done() or future.cancelled():
+                self._remove(future)
+            else:
+                # granted as it was cancelled, hand the quota back
+                self.requests.level += 1
+                self.tokens.level += num_tokens
+                self._dispatch()
+            raise
+        finally:
+            stats.queue_depth -= 1
+
+        waited = time.monotonic() - start
+        stats.num_acquired += 1
+        stats.wait_seconds += waited
+        stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+
+    def try_acquire(self, priority: Priority, num_tokens: float) -> bool:
+        """Take quota only if it's free now and nothing is waiting, never queueing for it."""
+        num_tokens = min(num_tokens, self.tokens.capacity)
+        self.requests.refill()
+        self.tokens.refill()
+        if (
+            self._queue
+            or self.requests.seconds_until(1) > 0
+            or self.tokens.seconds_until(num_tokens) > 0
+        ):
+            return False
+        self.requests.level -= 1
+        self.tokens.level -= num_tokens
+        self.stats[priority].num_acquired += 1
+        return True
+
+    def correct_tokens(self, num_tokens: float):
+        """Take more tokens, or give some back, once the actual usage is known."""
+        self.tokens.level -= num_tokens
+        if num_tokens < 0:
+            self._dispatch()
+
+    def _remove(self, future: asyncio.Future):
+        self._queue = [entry for entry in self._queue if entry[3] is not future]
+        heapq.heapify(self._queue)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Grant waiting calls in order until the head doesn't fit, then sleep until it will."""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self.requests.refill()
+        self.tokens.refill()
+        while self._queue:
+            _, _, num_tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            wait = max(
+                self.requests.seconds_until(1), self.tokens.seconds_until(num_tokens)
+            )
+            if wait > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(
+                    wait, self._dispatch
+                )
+                return
+            heapq.heappop(self._queue)
+            self.requests.level -= 1
+            self.tokens.level -= num_tokens
+            future.set_result(None)
+
+    async def permit(self, priority: Priority, estimated_tokens: float) -> "Permit":
+        """Wait for quota for one call, returning a Permit to report its actual usage."""
+        await self.acquire(priority, estimated_tokens)
+        return Permit(self, estimated_tokens)
+
+    def try_permit(
+        self, priority: Priority, estimated_tokens: float
+    ) -> Optional["Permit"]:
+        """A Permit if quota is free right now, see try_acquire."""
+        if not self.try_acquire(priority, estimated_tokens):
+            return None
+        return Permit(self, estimated_tokens)
+
+    @asynccontextmanager
+    async def limit(self, priority: Priority, estimated_tokens: float):
+        """Wait for quota for one call, yielding a Permit to report its actual usage."""
+        yield await self.permit(priority, estimated_tokens)
+
+    def __str__(self):
+        lines = [f"rate limiter: {self.queue_depth} waiting"]
+        for priority, stats in self.stats.items():
+            lines.append(
+                f"  {priority.name.lower():<14} {stats.num_acquired:>5} calls, "
+                f"wait mean {1000 * stats.mean_wait_seconds:.0f}ms "
+                f"max {1000 * stats.max_wait_seconds:.0f}ms, "
+                f"queue depth {stats.queue_depth} (max {stats.max_queue_depth})"
+            )
+        return "\n".join(lines)
+
+
+class Permit:
+    def __init__(self, limiter: PriorityRateLimiter, estimated_tokens: float):
+        self._limiter = limiter
+        self._estimated_tokens = estimated_tokens
+
+    def record_usage(self, num_tokens: Optional[float]):
+        if num_tokens:
+            self._limiter.correct_tokens(num_tokens - self._estimated_tokens)
+
+
+def estimate_tokens(prompt: str) -> int:
+    return count_tokens(prompt) + ESTIMATED_COMPLETION_TOKENS
+
+
+class RateLimitedModel(WrapperModel):
+    """pydantic_ai model waiting on the shared rate limiter before each request."""
+
+    def __init__(self, wrapped: Model, priority: Priority):
+        super().__init__(wrapped)
+        self.priority = priority
+
+    async def request(
+        self,
+        messages: List[ModelMessage],
+        model_settings: Optional[ModelSettings],
+        model_request_parameters: ModelRequestParameters,
+    ) -> tuple[ModelResponse, Usage]:
+        prompt = ModelMessagesTypeAdapter.dump_json(messages).decode("utf-8")
+        async with get_rate_limiter().limit(
+            self.priority, estimate_tokens(prompt)
+        ) as permit:
+            response, usage = await self.wrapped.request(
+                messages, model_settings, model_request_parameters
+            )
+            permit.record_usage(usage.total_tokens)
+        return response, usage
+
+
+_shared_rate_limiter: Optional[PriorityRateLimiter] = None
+
+
+def get_rate_limiter() -> PriorityRateLimiter:
+    """Process-wide limiter, at RATE_LIMIT_REQUESTS_PER_MINUTE and RATE_LIMIT_TOKENS_PER_MINUTE."""
+    global _shared_rate_limiter
+    if _shared_rate_limiter is None:
+        _shared_rate_limiter = PriorityRateLimiter()
+    return _shared_rate_limiter
@@ -0,0 +1,283 @@
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+from src.rate_limiting import Permit, Priority, PriorityRateLimiter
+
+T = TypeVar("T")
+
+# Timeouts follow the observed latencies, once there are enough of them to trust.
+LATENCY_WINDOW_SIZE = 200
+MIN_LATENCY_SAMPLES = 20
+DEFAULT_TIMEOUT_SECONDS = 60.0
+TIMEOUT_PERCENTILE = 0.99
+TIMEOUT_MULTIPLIER = 3.0
+MIN_TIMEOUT_SECONDS = 10.0
+MAX_TIMEOUT_SECONDS = 120.0
+# a hedged request fires a duplicate once the first has outlasted this percentile
+HEDGE_PERCENTILE = 0.95
+
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+
+# consecutive failures before requests fail fast, and for how long
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+
+# overloaded or failing server side, worth another try
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@dataclass
+class RequestCounters:
+    requests: int = 0
+    retries: int = 0
+    hedges: int = 0
+    # hedges that answered before the request they duplicated
+    hedge_wins: int = 0
+    timeouts: int = 0
+    failures: int = 0
+    rejected_by_circuit: int = 0
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests, {self.retries} retries, {self.hedges} hedges "
+            f"({self.hedge_wins} won), {self.timeouts} timeouts, {self.failures} failures, "
+            f"{self.rejected_by_circuit} rejected by the circuit breaker"
+        )
+
+
+class LatencyTracker:
+    """Latencies of the most recent successful requests."""
+
+    def __init__(self, window_size: int = LATENCY_WINDOW_SIZE):
+        self._latencies = deque(maxlen=window_size)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def record(self, seconds: float):
+        self._latencies.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """None until there are MIN_LATENCY_SAMPLES latencies."""
+        if len(self._latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    def timeout(self) -> float:
+        p99 = self.percentile(TIMEOUT_PERCENTILE)
+        if p99 is None:
+            return DEFAULT_TIMEOUT_SECONDS
+        return min(
+            max(TIMEOUT_MULTIPLIER * p99, MIN_TIMEOUT_SECONDS), MAX_TIMEOUT_SECONDS
+        )
+
+
+class CircuitBreaker:
+    """Fails requests fast after repeated failures, rather than queueing them on a dead api.
+
+    Once open for cooldown_seconds, a single trial request is let through. Its success
+    closes the circuit, its failure opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        cooldown_seconds: float = CIRCUIT_COOLDOWN_SECONDS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.num_consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._is_trial_running = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_request(self) -> bool:
+        """Whether the request is the trial, raising CircuitOpenError if it can't be sent."""
+        if self._opened_at is None:
+            return False
+        if (
+            self._is_trial_running
+            or time.monotonic() - self._opened_at < self.cooldown_seconds
+        ):
+            raise CircuitOpenError(
+                f"{self.num_consecutive_failures} consecutive requests failed, "
+                f"not retrying for {self.cooldown_seconds:.0f}s"
+            )
+        self._is_trial_running = True
+        return True
+
+    def record_success(self):
+        self.num_consecutive_failures = 0
+        self._opened_at = None
+        self._is_trial_running = False
+
+    def abandon_trial(self):
+        """The trial request ended without an outcome, eg cancelled, let another try."""
+        self._is_trial_running = False
+
+    def record_failure(self):
+        self.num_consecutive_failures += 1
+        if self._is_trial_running or (
+            self.num_consecutive_failures >= self.failure_threshold
+        ):
+            self._opened_at = time.monotonic()
+        self._is_trial_running = False
+
+
+def backoff_delay(retry: int) -> float:
+    """Exponential backoff with full jitter, so clients retrying together spread out."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**retry))
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (asyncio.TimeoutError, httpx.TransportError))
+
+
+class ResilientRequester:
+    """Runs requests with adaptive timeouts, retries with backoff, a circuit breaker and hedging.
+
+    send is called once per attempt, so each retry or hedge is a fresh request. With a
+    rate_limiter, each attempt waits for its own Permit and gets it as send's argument.
+    The wait is the local queue's, not the api's, so timeouts and latencies start after it.
+    """
+
+    def __init__(self):
+        self.latencies = LatencyTracker()
+        self.circuit_breaker = CircuitBreaker()
+        self.counters = RequestCounters()
+
+    async def call(
+        self,
+        send: Callable[[Optional[Permit]], Awaitable[T]],
+        num_retries: int = 0,
+        hedge: bool = False,
+        timeout: Optional[float] = None,
+        rate_limiter: Optional[PriorityRateLimiter] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        estimated_tokens: float = 0,
+    ) -> T:
+        """send's result, raising its last error once retries run out.
+
+        Args:
+            num_retries: Further attempts after a retryable failure
+            hedge: Fire a duplicate request if the first outlasts the p95 latency
+            timeout: Seconds per attempt, adapted from observed latencies if None
+            rate_limiter: Waited on at priority for estimated_tokens before each attempt
+        """
+        self.counters.requests += 1
+        for retry in range(1 + num_retries):
+            if retry:
+                self.counters.retries += 1
+            # before claiming the circuit's trial slot, as the wait may be cancelled
+            permit = None
+            if rate_limiter is not None:
+                permit = await rate_limiter.permit(priority, estimated_tokens)
+            try:
+                is_trial = self.circuit_breaker.before_request()
+            except CircuitOpenError:
+                self.counters.rejected_by_circuit += 1
+                raise
+
+            start = time.perf_counter()
+            try:
+                result = await self._attempt(
+                    send,
+                    permit,
+                    timeout or self.latencies.timeout(),
+                    hedge,
+                    lambda: rate_limiter.try_permit(priority, estimated_tokens),
+                )
+            except Exception as e:
+                # other errors are the request's fault, the api itself answered
+                if is_retryable(e):
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.counters.timeouts += 1
+                if not is_retryable(e) or retry == num_retries:
+                    self.counters.failures += 1
+                    raise
+                print(f"Error: {e!r}, retrying")
+                await asyncio.sleep(backoff_delay(retry))
+                continue
+            except BaseException:
+                # cancelled, so it's neither a success nor a failure
+                if is_trial:
+                    self.circuit_breaker.abandon_trial()
+                raise
+
+            self.latencies.record(time.perf_counter() - start)
+            self.circuit_breaker.record_success()
+            return result
+
+    async def _attempt(
+        self,
+        send: Callable[[Optional[Permit]], Awaitable[T]],
+        permit: Optional[Permit],
+        timeout: float,
+        hedge: bool,
+        try_hedge_permit: Callable[[], Optional[Permit]],
+    ) -> T:
+        tasks = [asyncio.create_task(asyncio.wait_for(send(permit), timeout))]
+        try:
+            hedge_delay = self.latencies.percentile(HEDGE_PERCENTILE) if hedge else None
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                # a hedge only goes out on quota that's free now, it never queues for it
+                hedge_permit = None
+                if not done and permit is not None:
+                    hedge_permit = try_hedge_permit()
+                if not done and (permit is None or hedge_permit is not None):
+                    self.counters.hedges += 1
+                    tasks.append(
+                        asyncio.create_task(
+                            asyncio.wait_for(send(hedge_permit), timeout)
+                        )
+                    )
+
+            # the first success wins, an error only counts once both have failed
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.counters.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+_shared_requester: Optional[ResilientRequester] = None
+
+
+def get_requester() -> ResilientRequester:
+    """Process-wide requester for completion, so latencies and counters accumulate."""
+    global _shared_requester
+    if _shared_requester is None:
+        _shared_requester = ResilientRequester()
+    return _shared_requester
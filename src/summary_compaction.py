@@ -0,0 +1,101 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field, conint
+from pydantic_ai import Agent
+from sqlalchemy.orm import Session
+
+from src.conversation import make_llm_model
+from src.db import ContextItem, MessageSummary, reserve_ids
+from src.embeddings import get_embeddings
+from src.knowledge_snapshot import get_knowledge_snapshot
+from src.rate_limiting import Priority
+
+# Summaries at each level beyond the newest few are merged, this many at a time, into one
+# summary a level up. Each level keeps fewer than NUM_RECENT_SUMMARIES_KEPT +
+# SUMMARIES_PER_COMPACTION summaries, so their total only grows with the number of levels.
+SUMMARIES_PER_COMPACTION = 4
+NUM_RECENT_SUMMARIES_KEPT = 4
+MAX_SUMMARY_LEVEL = 4
+
+
+class CompactedSummaryModel(BaseModel):
+    body: str = Field(
+        description="A single summary of the whole period, first person. Keep what stands out or seems important at this longer time scale, and drop detail that only mattered at the time."
+    )
+    importance: conint(ge=1, le=10) = Field(
+        description="Strategic importance. 1 is trivial, 5 is probably important, and 10 is absolutely critical"
+    )
+    salience: conint(ge=1, le=10) = Field(
+        description="Emotional valence. 1 is has no affect on you, 5 has some emotional impact, and 10 is a burned in part of your identity"
+    )
+
+
+summary_compactor_agent = Agent(
+    model=make_llm_model(Priority.CONSOLIDATION),
+    result_type=CompactedSummaryModel,
+)
+
+
+def find_compaction_run(session: Session) -> Optional[List[MessageSummary]]:
+    """The oldest run of summaries due to be merged, lowest level first, from the snapshot."""
+    summaries_by_level: Dict[int, List[MessageSummary]] = {}
+    for summary in get_knowledge_snapshot(session).message_summaries.values():
+        summaries_by_level.setdefault(summary.level or 0, []).append(summary)
+
+    for level in sorted(summaries_by_level):
+        if level >= MAX_SUMMARY_LEVEL:
+            continue
+        summaries = sorted(
+            summaries_by_level[level],
+            key=lambda summary: (summary.created_at_message_index, summary.id),
+        )
+        old_summaries = summaries[: len(summaries) - NUM_RECENT_SUMMARIES_KEPT]
+        if len(old_summaries) >= SUMMARIES_PER_COMPACTION:
+            return old_summaries[:SUMMARIES_PER_COMPACTION]
+    return None
+
+
+async def compact_run(session: Session, run: List[MessageSummary]) -> MessageSummary:
+    """Merge a run of summaries into one a level up, retiring them in the same commit."""
+    summaries_text = "\n\n".join(f"- {summary.body}" for summary in run)
+    prompt = f"""\
+You are maintaining your memory system, compressing older memories as they fade.
+Below are summaries of consecutive periods of your past, oldest first.
+
+SUMMARIES
+{summaries_text}
+
+Merge them into one summary of the whole period.
+"""
+    result = await summary_compactor_agent.run(prompt)
+    vector = (await asyncio.to_thread(get_embeddings().embed, result.data.body))[0]
+
+    entities = {entity.id: entity for summary in run for entity in summary.entities}
+    facts = {fact.id: fact for summary in run for fact in summary.facts}
+    parent_id = next(reserve_ids(session, {ContextItem: 1})[ContextItem])
+    parent = MessageSummary(
+        id=parent_id,
+        body=result.data.body,
+        importance=result.data.importance,
+        salience=result.data.salience,
+        level=(run[0].level or 0) + 1,
+        created_at_message_index=run[0].created_at_message_index,
+        updated_at_message_index=run[-1].created_at_message_index,
+        entities=list(entities.values()),
+        facts=list(facts.values()),
+    )
+    parent.set_embedding(vector)
+    session.add(parent)
+    for summary in run:
+        summary.retired_by = parent_id
+    session.commit()
+    return parent
+
+
+async def compact_message_summaries(session: Session) -> List[MessageSummary]:
+    """Merge every run of summaries that's due, cascading up the levels."""
+    parents = []
+    while (run := find_compaction_run(session)) is not None:
+        parents.append(await compact_run(session, run))
+    return parents
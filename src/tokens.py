@@ -0,0 +1,31 @@
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+
+# Claude's tokenizer isn't available locally, cl100k is a close enough stand-in for budgeting.
+TOKENIZER_ENCODING = "cl100k_base"
+
+# Rough English average, only used when the encoding can't be loaded.
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+
+# tiktoken downloads the encoding on first use, offline that fails and we estimate instead.
+@lru_cache(maxsize=None)
+def get_tokenizer() -> Optional[tiktoken.Encoding]:
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        print(
+            f"Couldn't load {TOKENIZER_ENCODING} ({e!r}), estimating token counts from length"
+        )
+        return None
+
+
+# Context items are rendered the same way every turn, so caching by text caches per item.
+@lru_cache(maxsize=100_000)
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return max(len(text.split()), -(-len(text) // CHARS_PER_TOKEN_ESTIMATE))
+    return len(tokenizer.encode(text, disallowed_special=()))